@@ -1,24 +1,54 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Optional, List, TypeVar, Dict, Set, Callable
-from os import path, listdir, environ, walk
-from zipfile import ZipFile
-from urllib.parse import urlparse, parse_qs, ParseResult, unquote
-from functools import lru_cache
+from typing import Optional, List, TypeVar, Dict, Set, Callable, Any, Tuple, Iterable, Iterator, BinaryIO, TYPE_CHECKING
+from os import path, listdir, environ, scandir, stat, fstat, sep, makedirs, replace, unlink, utime
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, RLock, Thread, Condition
+from collections import OrderedDict
+from time import monotonic, perf_counter, sleep, time
+from contextlib import contextmanager
+from bisect import bisect_left
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, BadZipFile
+from urllib.parse import urlparse, parse_qs, ParseResult, unquote, urlencode
 from math import floor
+from stat import S_ISDIR
 import html
 import re
 import email.utils
 import bz2
-import subprocess
+import zlib
+import gzip
+import io
+import socket
+import struct
+import secrets
+import hashlib
+import json
+import shutil
+import sys
+import os
+import random
+import importlib.util
 
+if TYPE_CHECKING:
+    # only imported by the code paths of the features needing them (together they cost ~7 MiB of idle RSS)
+    import asyncio
+    import sqlite3
+    from concurrent.futures import ProcessPoolExecutor
+    import cProfile
+    import pstats
 
-ff_to_png: Callable[[bytes], bytes] = lambda x: subprocess.Popen(["magick", "FF:-", "PNG:-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(x)[0]
+T = TypeVar('T')
+popcount: Callable[[int], int] = getattr(int, "bit_count", lambda value: bin(value).count("1"))  # int.bit_count: python 3.10+
+
+# optional: used to send .ff.bz2 pages as (smaller) webp to clients supporting it (imported on first use)
+PIL_AVAILABLE: bool = importlib.util.find_spec("PIL") is not None
 
 try:
-    from wand.image import Image  # type: ignore
-    ff_to_png = lambda x: Image(blob=x, format="FF").make_blob(format="PNG")
+    # optional: brotli compression (gzip is always available)
+    import brotli  # type: ignore
+    BROTLI_AVAILABLE: bool = True
 except ModuleNotFoundError:
-    pass
+    BROTLI_AVAILABLE = False
 
 
 # common mimes used by hand
@@ -51,7 +81,7 @@ IMAGE_FILE_EXTENSIONS: List[str] = [
     "webp",
 ]
 
-HTML_HEAD: str = '''
+HTML_HEAD_START: str = '''
 <!DOCTYPE HTML><html><head>
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <style>
@@ -66,321 +96,2276 @@ HTML_HEAD: str = '''
         .st{width:0px!important;height:0px!important;overflow:hidden!important;display:inline-block!important;}
         @media (pointer:coarse) or (max-aspect-ratio:0.7){body,img{width:100%;}}
         @media (min-aspect-ratio:1){img{width:calc(0.8*100vh);}}
-    </style></head><body>
+    </style>'''
+HTML_HEAD_END: str = '''</head><body>
 '''
+HTML_HEAD: str = HTML_HEAD_START + HTML_HEAD_END
 HTML_TAIL: str = '</body></html>'
 
 QUERY_URL_SUFFIX: str = "/query"
+API_URL_PREFIX: str = "/api/"
+API_ENDPOINTS: List[str] = ["list", "tags", "search", "chapter"]
+METRICS_URL: str = "/metrics"
+PROFILE_URL: str = "/metrics/profile"
+MAX_FACETS: int = 50  # tags offered to refine search results
 CLEAR_CACHE_URL_SUFFIX: str = "/clear_serverside_cache"
 TAGFILE_NAME: str = "tagfile.txt"
 
+COPY_CHUNK_SIZE: int = 64 * 1024
+PNG_COMPRESSION_LEVEL: int = 6
+MIN_THUMBNAIL_WIDTH: int = 16
+MAX_THUMBNAIL_WIDTH: int = 2000
+THUMBNAIL_QUALITY: int = 75
+THUMBNAIL_SOURCE_EXTENSIONS: List[str] = ["gif", "jpeg", "jpg", "png", "webp"]  # svg is small and scales anyway
+PREFETCH_NEXT_CHAPTER_PAGES: int = 3
+TRANSCODE_WIDTHS: List[int] = [360, 540, 720, 1080, 1440, 2160]  # requested widths get rounded up to one of these
+TRANSCODE_DISPLAY_WIDTH: int = 1080  # css pixels a page takes up at most in the reader (if TRANSCODE is enabled)
+TRANSCODE_MAX_HEIGHT: int = 16383  # webp can not be higher (long strips get narrower instead)
+CLIENT_HINTS: List[str] = ["Sec-CH-Width", "Sec-CH-Viewport-Width", "Sec-CH-DPR"]
+PDF_PAGE_QUALITY: int = 85  # rendered pdf pages are sent as webp/ jpeg of this quality if Pillow is installed (png otherwise)
+PDF_RENDER_TIMEOUT: float = 60.0  # seconds pdftoppm/ pdfinfo may take
+STREAM_BLOCK_SIZE: int = 16 * 1024
+COMPRESSIBLE_EXTENSIONS: List[str] = ["css", "html", "js", "json", "svg", "txt"]
+ENCODING_FILE_EXTENSIONS: Dict[str, str] = {"br": "br", "gzip": "gz"}  # precompressed siblings (example: main.js.gz)
+MIN_COMPRESS_SIZE: int = 512
+MAX_COMPRESS_SIZE: int = 8 * 1024 * 1024  # bigger files do not get compressed on the fly
+GZIP_LEVEL: int = 6
+BROTLI_QUALITY: int = 5
+MAX_RANGES: int = 16  # more ranges within one request get ignored (-> whole file)
+KEEP_ALIVE_TIMEOUT: float = 15.0  # SERVER=asyncio: idle connections get closed after x seconds
+SEND_TIMEOUT: float = 60.0  # SERVER=asyncio: a response gets aborted if the client does not accept data for x seconds
+MAX_REQUEST_HEAD: int = 64 * 1024
+CBZ_IMAGE_CACHE_CONTROL: str = "max-age=604800"
+# zip local file header (signature, versions, flags, compression, time, date, crc, sizes, filename length, extra field length)
+LOCAL_FILE_HEADER: struct.Struct = struct.Struct("<4s5H3L2H")
+
+FOLDER_IMAGE_NAMES: List[str] = [f"folder.{i}" for i in IMAGE_FILE_EXTENSIONS]
+
 FILES_TO_NOT_INDEX: List[str] = [
-    *(f"folder.{i}" for i in IMAGE_FILE_EXTENSIONS),
+    *FOLDER_IMAGE_NAMES,
     TAGFILE_NAME,
     "meta_data.json",
+    ".guya_sync.json",  # downloader/guya.py
 ]
 
 
+# process pool for cpu-heavy work (bz2 decompression, ff->png conversion)
+# None -> run it on the request thread
+cpu_pool: Optional["ProcessPoolExecutor"] = None
+
+
+# HTTPServer handling requests on a bounded thread-pool instead of one thread per request
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, server_address: tuple, handler: Callable, threads: int) -> None:
+        self.threads: int = threads
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="cbzerv")
+        self.pending: int = 0  # accepted requests which are not finished yet (running + queued)
+        self._pending_lock: Lock = Lock()
+        self._last_saturation_report: float = 0.0
+        super().__init__(server_address, handler)  # (calls server_close if binding fails)
+
+    def process_request(self, request: socket.socket, client_address: tuple) -> None:
+        with self._pending_lock:
+            self.pending += 1
+            queued: int = self.pending - self.threads
+        if queued > 0 and monotonic() - self._last_saturation_report > 1.0:
+            self._last_saturation_report = monotonic()
+            sys.stderr.write(f"server saturated: {queued} request(s) queued ({self.threads} threads busy)\n")
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request: socket.socket, client_address: tuple) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._pending_lock:
+                self.pending -= 1
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# opt-in instrumentation (METRICS), exposed in the prometheus text-format at METRICS_URL
+class Metrics:
+    BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self) -> None:
+        self._lock: Lock = Lock()
+        self._requests: Dict[Tuple[str, int], int] = {}  # (endpoint, status) -> count
+        self._sent_bytes: Dict[str, int] = {}  # endpoint -> bytes
+        self._durations: Dict[str, List[float]] = {}  # endpoint -> [bucket counts.., +Inf count, sum]
+        self._stages: Dict[str, List[float]] = {}  # stage -> [calls, seconds]
+        self._counters: Dict[str, int] = {}
+
+    def observe_request(self, endpoint: str, status: int, seconds: float, sent_bytes: int) -> None:
+        with self._lock:
+            self._requests[(endpoint, status)] = self._requests.get((endpoint, status), 0) + 1
+            self._sent_bytes[endpoint] = self._sent_bytes.get(endpoint, 0) + sent_bytes
+            histogram: List[float] = self._durations.setdefault(endpoint, [0.0] * (len(self.BUCKETS) + 2))
+            histogram[bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            totals: List[float] = self._stages.setdefault(stage, [0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @staticmethod
+    def label(value: Any) -> str:
+        # escaped label value (prometheus text-format)
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def render(self, server: Any) -> str:
+        lines: List[str] = []
+        label: Callable[[Any], str] = self.label
+        with self._lock:
+            lines.append("# TYPE cbzerv_requests_total counter")
+            lines += (f'cbzerv_requests_total{{endpoint="{label(e)}",status="{s}"}} {n}' for (e, s), n in sorted(self._requests.items()))
+            lines.append("# TYPE cbzerv_response_bytes_total counter")
+            lines += (f'cbzerv_response_bytes_total{{endpoint="{label(e)}"}} {n}' for e, n in sorted(self._sent_bytes.items()))
+            lines.append("# TYPE cbzerv_request_duration_seconds histogram")
+            for endpoint, histogram in sorted(self._durations.items()):
+                endpoint = label(endpoint)
+                cumulative: float = 0
+                for bound, count in zip((*self.BUCKETS, "+Inf"), histogram):
+                    cumulative += count
+                    lines.append(f'cbzerv_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative:.0f}')
+                lines.append(f'cbzerv_request_duration_seconds_sum{{endpoint="{endpoint}"}} {histogram[-1]:.6f}')
+                lines.append(f'cbzerv_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative:.0f}')
+            lines.append("# TYPE cbzerv_stage_seconds_total counter")
+            lines += (f'cbzerv_stage_seconds_total{{stage="{label(k)}"}} {v[1]:.6f}' for k, v in sorted(self._stages.items()))
+            lines.append("# TYPE cbzerv_stage_calls_total counter")
+            lines += (f'cbzerv_stage_calls_total{{stage="{label(k)}"}} {v[0]:.0f}' for k, v in sorted(self._stages.items()))
+            lines += (f"# TYPE cbzerv_{k}_total counter\ncbzerv_{k}_total {v}" for k, v in sorted(self._counters.items()))
+        caches: Dict[str, BoundedLru] = {
+            "cbz": cbz_cache, "listing": listing_cache, "compressed": compressed_cache,
+            "page": page_cache.memory, "thumbnail": thumbnail_cache.memory, "transcode": transcode_cache.memory,
+            "pdf": pdf_cache.memory, "pdf_page_count": pdf_page_counts,
+        }
+        for metric, kind, attribute in (
+            ("hits_total", "counter", "hits"), ("misses_total", "counter", "misses"),
+            ("entries", "gauge", "__len__"), ("bytes", "gauge", "current_bytes"),
+        ):
+            lines.append(f"# TYPE cbzerv_cache_{metric} {kind}")
+            for name, cache in caches.items():
+                value: Any = getattr(cache, attribute)
+                lines.append(f'cbzerv_cache_{metric}{{cache="{name}"}} {value() if callable(value) else value}')
+        lines.append("# TYPE cbzerv_cache_disk_hits_total counter")
+        lines += (f'cbzerv_cache_disk_hits_total{{cache="{k}"}} {v.disk_hits}' for k, v in (("page", page_cache), ("thumbnail", thumbnail_cache), ("transcode", transcode_cache), ("pdf", pdf_cache)))
+        if isinstance(server, (PooledHTTPServer, AsyncHTTPServer)):
+            lines.append(f"# TYPE cbzerv_pending_requests gauge\ncbzerv_pending_requests {server.pending}")
+        if isinstance(server, AsyncHTTPServer):
+            lines.append(f"# TYPE cbzerv_open_connections gauge\ncbzerv_open_connections {server.connections}")
+        return "\n".join(lines) + "\n"
+
+
+# counts the bytes written to the client
+class CountingWriter:
+    def __init__(self, wrapped: Any) -> None:
+        self.wrapped: Any = wrapped
+        self.written: int = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        return self.wrapped.write(data)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.wrapped, name)
+
+
+metrics: Optional[Metrics] = None
+profile_rate: float = 0.0  # fraction of the requests run with cProfile (PROFILE)
+profile_stats: Optional["pstats.Stats"] = None  # combined profile of these requests
+_profile_lock: Lock = Lock()
+_profiler_slot: Lock = Lock()  # one profiled request at a time (python 3.12+ only allows one active profiler)
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    if metrics is None:
+        yield
+        return
+    start: float = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe_stage(stage, perf_counter() - start)
+
+def add_profile(profiler: "cProfile.Profile") -> None:
+    global profile_stats
+    import pstats
+    with _profile_lock:
+        if profile_stats is None:
+            profile_stats = pstats.Stats(profiler)
+        else:
+            profile_stats.add(profiler)
+
+
 class RequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 for chunked responses. connections still get closed after each response (see end_headers)
+    protocol_version = "HTTP/1.1"
+    keep_alive: bool = False
+
+    endpoint: str = "other"  # label for the metrics, set by the dispatch in handle_get
+    status: int = 0
+
+    def setup(self) -> None:
+        super().setup()
+        if metrics is not None:
+            self.wfile = CountingWriter(self.wfile)
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        self.status = code
+        super().send_response(code, message)
+
+    def end_headers(self) -> None:
+        if not self.keep_alive and not self.close_connection:
+            # idle keep-alive connections would occupy the request-threads
+            self.send_header("Connection", "close")
+        super().end_headers()
+
     def do_POST(self) -> None:
-        self.send_response(501)  # Not Implemented
-        self.send_header("Content-Type", MIME_TEXT)
-        self.end_headers()
-        self.wfile.write(b'POST is not supported')
+        self.send_body(b'POST is not supported', MIME_TEXT, 501)  # Not Implemented
 
     def do_GET(self) -> None:
+        if metrics is None and not profile_rate:
+            self.handle_get()
+            return
+        start: float = perf_counter()
+        profiler: Optional["cProfile.Profile"] = None
+        if random.random() < profile_rate and _profiler_slot.acquire(False):
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:  # another profiling tool is active
+                _profiler_slot.release()
+                profiler = None
+        try:
+            self.handle_get()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                _profiler_slot.release()
+                add_profile(profiler)
+            if metrics is not None:
+                metrics.observe_request(self.endpoint, self.status, perf_counter() - start, getattr(self.wfile, "written", 0))
+
+    def handle_get(self) -> None:
         parsedurl = urlparse(self.path)
+        if metrics is not None and parsedurl.path in (METRICS_URL, PROFILE_URL):
+            self.endpoint = "metrics"
+            self.send_metrics(parsedurl.path == PROFILE_URL)
+            return
+        if parsedurl.path.startswith(API_URL_PREFIX):
+            api_endpoint: str = parsedurl.path[len(API_URL_PREFIX):].strip("/")
+            self.endpoint = f"api_{api_endpoint}" if api_endpoint in API_ENDPOINTS else "api_other"  # (bounded label values)
+            self.handle_api(parsedurl)
+            return
         if parsedurl.path.endswith(CLEAR_CACHE_URL_SUFFIX):
-            read_tagfile.cache_clear()
-            self.send_response(200)
-            self.send_header("Content-Type", MIME_HTML)
-            self.end_headers()
-            self.wfile.write(
-                f'{HTML_HEAD}Cleared cache <a href="{html.escape(parsedurl.path[:-len(CLEAR_CACHE_URL_SUFFIX)])}">Back</a>{HTML_TAIL}'
-                .encode(encoding="utf-8", errors="replace")
-            )
+            self.endpoint = "clear_cache"
+            get_tag_index().rescan()
+            self.send_html(f'{HTML_HEAD}Cleared cache <a href="{html.escape(parsedurl.path[:-len(CLEAR_CACHE_URL_SUFFIX)])}">Back</a>{HTML_TAIL}')
             return
         target_file: str = path.abspath(path.join(path.curdir, unquote(parsedurl.path.lstrip("/"))))
         if not target_file.startswith(path.abspath(path.curdir)):
-            self.send_response(403)
-            self.end_headers()
+            self.send_body(b"", MIME_TEXT, 403)
             return
         if (parsedurl.path.endswith(QUERY_URL_SUFFIX)):
+            self.endpoint = "search" if parsedurl.query else "query_page"
             self.handle_query(parsedurl, target_file)
             return
         if not path.exists(target_file):
-            self.send_response(404)
-            self.send_header("Content-Type", MIME_HTML)
-            self.end_headers()
-            self.wfile.write(f"{HTML_HEAD}<h1>404</h1>{HTML_TAIL}".encode(encoding="utf-8", errors="replace"))
+            self.send_html(f"{HTML_HEAD}<h1>404</h1>{HTML_TAIL}", 404)
             return
 
         if not path.isfile(target_file):
             if path.isfile(path.join(target_file, "index.html")):
-                self.send_response(307)
-                self.send_header("Location", f"{parsedurl.path}/index.html")
-                self.end_headers()
+                self.send_body(b"", MIME_TEXT, 307, {"Location": f"{parsedurl.path}/index.html"})
                 return
+            self.endpoint = "index"
             self.send_index(target_file, parsedurl)
             return
 
         file_ext: str = path.splitext(target_file)[1].lstrip(".").lower()
 
+        if file_ext == "pdf":
+            # (has a mime as well, send_pdf sends the raw file for ?file=true)
+            query: Dict[str, List[str]] = parse_qs(parsedurl.query)
+            self.endpoint = "pdf_image" if "page" in query else "pdf_thumbnail" if "thumb" in query else "pdf_file" if query else "pdf_page"
+            self.send_pdf(target_file, parsedurl)
+            return
+
         mime: Optional[str] = get_mime(file_ext)
 
         if mime is None:
             if file_ext == "cbz":
+                query = parse_qs(parsedurl.query)
+                self.endpoint = "cbz_image" if "image" in query else "cbz_thumbnail" if "thumb" in query else "cbz_page"
                 self.send_cbz(target_file, parsedurl)
                 return
-            if file_ext == "pdf":
-                self.send_pdf(target_file, parsedurl)
-                return
             self.return_unsupported_mime(file_ext)
             return
 
-        last_edited: str = email.utils.formatdate(path.getmtime(target_file))
+        if file_ext in THUMBNAIL_SOURCE_EXTENSIONS and thumbnail_width and "thumb=" in parsedurl.query:
+            self.endpoint = "thumbnail"
+            file_stat = stat(target_file)
+            self.send_thumbnail(
+                target_file,
+                file_stat.st_mtime_ns,
+                make_etag(file_stat.st_mtime_ns, file_stat.st_size),
+                get_query_value(parsedurl, "thumb"),
+                lambda: read_file(target_file),
+                parsedurl.path,
+            )
+            return
+        self.endpoint = "static"
+        self.send_static_file(target_file, mime, "max-age=604800" if file_ext in IMAGE_FILE_EXTENSIONS else None)
+
+    def send_metrics(self, profile: bool) -> None:
+        if not profile:
+            self.send_body(metrics.render(self.server).encode(), "text/plain; version=0.0.4", headers={"Cache-Control": "no-store"})  # type: ignore
+            return
+        output: io.StringIO = io.StringIO()
+        with _profile_lock:
+            if profile_stats is None:
+                output.write(f"no profiled requests yet (PROFILE={profile_rate})\n")
+            else:
+                profile_stats.stream = output  # type: ignore
+                profile_stats.sort_stats("cumulative").print_stats(60)
+        self.send_body(output.getvalue().encode(), MIME_TEXT, headers={"Cache-Control": "no-store"})
+
+    def send_thumbnail(
+        self, source: str, source_mtime_ns: int, source_etag: str, width_param: str, read_source: Callable[[], bytes], full_image_url: str,
+    ) -> None:
+        # read_source gets called within the thumbnail worker-pool, until the thumbnail exists the client gets redirected to full_image_url
+        width: int = int(width_param) if width_param.isdigit() else 0
+        if not MIN_THUMBNAIL_WIDTH <= width <= MAX_THUMBNAIL_WIDTH:
+            self.send_body(f"thumb has to be between {MIN_THUMBNAIL_WIDTH} and {MAX_THUMBNAIL_WIDTH}".encode(encoding="utf-8", errors="replace"), MIME_TEXT, 400)  # bad request
+            return
+        image_format: str = "webp" if "image/webp" in self.headers.get("Accept", "") else "jpeg"
+        etag: str = f'{source_etag[:-1]}-{width}-{image_format}"'
+        mtime: float = source_mtime_ns / 1e9
+        if self.send_not_modified(etag, mtime, CBZ_IMAGE_CACHE_CONTROL):
+            return
+        key: str = f"{source}\0{source_mtime_ns}\0{width}\0{image_format}"
+        thumbnail: Optional[bytes] = thumbnail_cache.get(key)
+        if thumbnail is None:
+            thumbnail_cache.create_in_background(key, lambda: run_cpu_bound(make_thumbnail, read_source(), width, image_format), thumbnail_pool)
+            self.send_body(b"", MIME_TEXT, 307, {"Location": full_image_url, "Cache-Control": "no-store"})  # temporary redirect
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", get_mime(image_format) or "")
+        self.send_header("Content-Length", str(len(thumbnail)))
+        self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CBZ_IMAGE_CACHE_CONTROL)
+        self.send_header("Vary", "Accept")
+        self.end_headers()
+        self.wfile.write(thumbnail)
+
+    def send_static_file(self, file: str, mime: str, cache_control: Optional[str] = None) -> None:
+        if path.splitext(file)[1].lstrip(".").lower() in COMPRESSIBLE_EXTENSIONS and "Range" not in self.headers:
+            encoding: Optional[str] = negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+            if encoding is not None and self.send_compressed_static_file(file, mime, encoding, cache_control):
+                return
+        with open(file, "rb") as f:
+            file_stat = fstat(f.fileno())
+            etag: str = make_etag(file_stat.st_mtime_ns, file_stat.st_size)
+            if self.send_not_modified(etag, file_stat.st_mtime, cache_control):
+                return
+            ranges: Optional[List[Tuple[int, int]]] = self.parse_range_header(file_stat.st_size, etag, file_stat.st_mtime)
+            if ranges == []:
+                self.send_response(416)  # range not satisfiable
+                self.send_header("Content-Range", f"bytes */{file_stat.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200 if ranges is None else 206)  # 206: partial content
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", email.utils.formatdate(file_stat.st_mtime, usegmt=True))
+            if cache_control is not None:
+                self.send_header("Cache-Control", cache_control)
+            if ranges is None:
+                self.send_header("Content-Type", mime)
+                self.send_header("Content-Length", str(file_stat.st_size))
+                self.end_headers()
+                self.send_file_contents(f, 0, file_stat.st_size)
+                return
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_header("Content-Type", mime)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{file_stat.st_size}")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                self.send_file_contents(f, start, end - start + 1)
+                return
+            boundary: str = secrets.token_hex(16)
+            part_headers: List[bytes] = [
+                f"\r\n--{boundary}\r\nContent-Type: {mime}\r\nContent-Range: bytes {start}-{end}/{file_stat.st_size}\r\n\r\n".encode()
+                for start, end in ranges
+            ]
+            closing: bytes = f"\r\n--{boundary}--\r\n".encode()
+            self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+            self.send_header("Content-Length", str(
+                sum(len(i) for i in part_headers) + sum(end - start + 1 for start, end in ranges) + len(closing)
+            ))
+            self.end_headers()
+            for part_header, (start, end) in zip(part_headers, ranges):
+                self.wfile.write(part_header)
+                self.send_file_contents(f, start, end - start + 1)
+            self.wfile.write(closing)
+
+    def send_compressed_static_file(self, file: str, mime: str, encoding: str, cache_control: Optional[str]) -> bool:
+        # a precompressed sibling (file.gz, file.br) or the file compressed on the fly (memoised)
+        # -> False if the file is to big to be compressed on the fly
+        file_stat = stat(file)
+        sibling: str = f"{file}.{ENCODING_FILE_EXTENSIONS[encoding]}"
+        try:
+            sibling_stat: Optional[os.stat_result] = stat(sibling)
+        except OSError:
+            sibling_stat = None
+        if sibling_stat is not None:
+            body: bytes = read_file(sibling)
+        elif file_stat.st_size <= MAX_COMPRESS_SIZE:
+            cache_key: Tuple[str, int, int, str] = (file, file_stat.st_mtime_ns, file_stat.st_size, encoding)
+            cached: Optional[bytes] = compressed_cache.get(cache_key)
+            if cached is None:
+                cached = compress(read_file(file), encoding)
+                compressed_cache.put(cache_key, cached, len(cached))
+            body = cached
+        else:
+            return False
+        source_stat = sibling_stat or file_stat
+        etag: str = f'{make_etag(source_stat.st_mtime_ns, source_stat.st_size)[:-1]}-{encoding}"'
+        if self.send_not_modified(etag, file_stat.st_mtime, cache_control):
+            return True
         self.send_response(200)
         self.send_header("Content-Type", mime)
-        self.send_header("Last-Modified", last_edited)
-        if file_ext in IMAGE_FILE_EXTENSIONS:
-            self.send_header("Cache-Control", "max-age=604800")
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(file_stat.st_mtime, usegmt=True))
+        if cache_control is not None:
+            self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def send_not_modified(self, etag: str, mtime: Optional[float], cache_control: Optional[str] = None) -> bool:
+        # send a 304 if the clients cached version is still up to date (mtime None: only check the etag)
+        if_none_match: Optional[str] = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            fresh: bool = if_none_match.strip() == "*" or etag in (i.strip().removeprefix("W/") for i in if_none_match.split(","))
+        else:
+            fresh = mtime is not None and not_modified_since(self.headers.get("If-Modified-Since"), mtime)
+        if not fresh:
+            return False
+        self.send_response(304)  # not modified
+        self.send_header("ETag", etag)
+        if mtime is not None:
+            self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+        if cache_control is not None:
+            self.send_header("Cache-Control", cache_control)
         self.end_headers()
-        with open(target_file, "rb") as f:
-            self.wfile.write(f.read())
+        return True
+
+    def parse_range_header(self, size: int, etag: str, mtime: float) -> Optional[List[Tuple[int, int]]]:
+        # -> None: send everything; []: unsatisfiable; otherwise a list of (first byte, last byte)
+        range_header: Optional[str] = self.headers.get("Range")
+        if range_header is None or not range_header.startswith("bytes="):
+            return None
+        if_range: Optional[str] = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag and not (
+            not if_range.strip().startswith('"') and not_modified_since(if_range, mtime)
+        ):
+            return None  # the client has a different version -> send the whole new one
+        ranges: List[Tuple[int, int]] = []
+        for spec in range_header[len("bytes="):].split(","):
+            first, _, last = spec.strip().partition("-")
+            try:
+                if not first:  # suffix: the last x bytes
+                    if int(last) <= 0:
+                        continue
+                    ranges.append((max(size - int(last), 0), size - 1))
+                    continue
+                start: int = int(first)
+                end: int = min(int(last), size - 1) if last else size - 1
+            except ValueError:
+                return None  # invalid headers have to be ignored
+            if start > end:
+                if last and int(last) < start:
+                    return None  # syntactically invalid -> ignored
+                continue  # starts past the end -> unsatisfiable
+            ranges.append((start, end))
+        if len(ranges) > MAX_RANGES:
+            return None
+        return ranges
+
+    def send_file_contents(self, file_handle: BinaryIO, offset: int, count: int) -> None:
+        # zero-copy (sendfile) if the client is a plain socket, chunked copy otherwise
+        self.wfile.flush()
+        connection: Any = getattr(self, "connection", None)
+        ssl: Any = sys.modules.get("ssl")  # (no SSLSocket can exist without ssl being imported)
+        if isinstance(connection, socket.socket) and not (ssl is not None and isinstance(connection, ssl.SSLSocket)):
+            with timed("sendfile"):
+                sent: int = connection.sendfile(file_handle, offset, count)
+            if isinstance(self.wfile, CountingWriter):
+                self.wfile.written += sent
+            return
+        file_handle.seek(offset)
+        while count > 0:
+            chunk: bytes = file_handle.read(min(COPY_CHUNK_SIZE, count))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
 
     def send_pdf(self, file: str, parsedurl: ParseResult) -> None:
         query = parse_qs(parsedurl.query)
+        if pdf_renderer and "page" in query:
+            self.send_pdf_page(file, query["page"][0])
+            return
+        if pdf_renderer and thumbnail_width and "thumb" in query:
+            file_stat = stat(file)
+            self.send_thumbnail(
+                file,
+                file_stat.st_mtime_ns,
+                make_etag(file_stat.st_mtime_ns, file_stat.st_size),
+                query["thumb"][0],
+                lambda: render_pdf_page(file, 1, MAX_THUMBNAIL_WIDTH, pdf_renderer),
+                f"{parsedurl.path}?page=1",
+            )
+            return
         if query:
-            last_edited: str = email.utils.formatdate(path.getmtime(file))
-            self.send_response(200)
-            self.send_header("Content-Type", MIME_PDF)
-            self.send_header("Last-Modified", last_edited)
-            self.end_headers()
-            with open(file, "rb") as f:
-                self.wfile.write(f.read())
+            self.send_static_file(file, MIME_PDF)
             return
-        self.send_response(200)
-        self.send_header("Content-Type", MIME_HTML)
         # no clientside cache (both unlikely and would create issues when the next chapter releases)
-        self.end_headers()
         thisurl = html.escape(parsedurl.path)
+        if pdf_renderer:
+            try:
+                page_count: int = get_pdf_page_count(file)
+            except (OSError, PdfError) as e:
+                self.log_error("unable to read the pages of %s: %r", file, e)  # -> embed it as a whole
+            else:
+                self.send_pdf_reader(file, parsedurl, page_count)
+                return
         # https://www.w3docs.com/snippets/html/how-to-embed-pdf-in-html.html
         # https://www.w3docs.com/snippets/html/how-to-make-a-div-fill-the-height-of-the-remaining-space.html
-        self.wfile.write(f'''
+        self.send_html(f'''
             {HTML_HEAD}<div style="display:flex;flex-flow:column;height:100%">
                 <h1 style="flex:0 1 auto">{generate_html_pathstr(unquote(parsedurl.path))}</h1>
                 <object data="{thisurl}?file=true" type="application/pdf" width="100%" style="flex:1 1 auto">
                     <p>Unable to display PDF file. <a href="{thisurl}?file=true">Download</a> instead.</p>
                 </object>
             </div>{HTML_TAIL}
-        '''.encode(encoding="utf-8", errors="replace"))
+        ''')
+
+    def send_pdf_reader(self, file: str, parsedurl: ParseResult, page_count: int) -> None:
+        # like the cbz reader, pages only get rendered once the browser requests them
+        thispath = html.escape(parsedurl.path)
+        next_chapter: Optional[str] = None
+        try:
+            next_chapter = get_directory_listing(path.dirname(file)).neighbours(path.basename(file))[1]
+        except OSError:
+            pass
+        images_html: str = "<br>".join((
+            f'''<img src="{thispath}?page={i}"{' loading="lazy"' if i > 10 else ""}>'''
+            for i in range(1, page_count + 1)
+        ))
+        self.send_html(f'''
+            {HTML_HEAD_START}{f'<link rel="next" href="{html.escape(next_chapter)}">' if next_chapter else ""}{HTML_HEAD_END}
+                <style>body{{margin-left:auto;margin-right:auto;width:fit-content;}}</style>
+                <h1 id="h1_cbz_title">{generate_html_pathstr(unquote(parsedurl.path))}</h1>
+                <a href="{thispath}?file=true">Download</a><br>
+                {images_html}
+                {f'<br><a href="{html.escape(next_chapter)}">{html.escape(next_chapter)}</a>' if next_chapter else ""}
+                <br><br><br><a href="#h1_cbz_title" id="to_top_button">Go to top</a>
+            {HTML_TAIL}
+        ''')
+
+    def send_pdf_page(self, file: str, page_param: str) -> None:
+        try:
+            file_stat = stat(file)
+            page_count: int = get_pdf_page_count(file)
+        except (OSError, PdfError) as e:
+            self.log_error("unable to read the pages of %s: %r", file, e)
+            self.send_body(b"", MIME_TEXT, 500)
+            return
+        page: int = parse_int(page_param, 0)
+        if not 1 <= page <= page_count:
+            self.send_body(b"", MIME_TEXT, 404)
+            return
+        image_format: str = ("webp" if "image/webp" in self.headers.get("Accept", "") else "jpeg") if PIL_AVAILABLE else "png"
+        etag: str = f'{make_etag(file_stat.st_mtime_ns, file_stat.st_size)[:-1]}-{page}-{pdf_page_width}-{image_format}"'
+        if self.send_not_modified(etag, file_stat.st_mtime, CBZ_IMAGE_CACHE_CONTROL):
+            return
+
+        def render() -> bytes:
+            image: bytes = run_cpu_bound(render_pdf_page, file, page, pdf_page_width, pdf_renderer)
+            if image_format == "png":
+                return image
+            return run_cpu_bound(make_thumbnail, image, pdf_page_width, image_format, PDF_PAGE_QUALITY, TRANSCODE_MAX_HEIGHT)
+
+        try:
+            image: bytes = pdf_cache.get_or_create(
+                f"{file}\0{file_stat.st_mtime_ns}\0{page}\0{pdf_page_width}\0{image_format}",
+                lambda: pdf_pool.submit(render).result(),
+            )
+        except Exception as e:
+            self.log_error("unable to render page %d of %s: %r", page, file, e)
+            self.send_body(b"", MIME_TEXT, 500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", get_mime(image_format) or "")
+        self.send_header("Content-Length", str(len(image)))
+        self.send_header("Last-Modified", email.utils.formatdate(file_stat.st_mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CBZ_IMAGE_CACHE_CONTROL)
+        self.send_header("Vary", "Accept")
+        self.end_headers()
+        self.wfile.write(image)
 
     def send_cbz(self, file: str, parsedurl: ParseResult) -> None:
         query = parse_qs(parsedurl.query)
         if "image" in query:
-            last_edited: str = email.utils.formatdate(path.getmtime(file))
             imagefile: str = query["image"] if isinstance(query["image"], str) else query["image"][0]
             image_mime: Optional[str] = None
-            ff: bool = False
+            ff_target_format: Optional[str] = None
+            image_extension: str = ""
             if imagefile.endswith(".ff.bz2"):
-                image_mime = get_mime("png")
-                ff = True
+                ff_target_format = "webp" if PIL_AVAILABLE and "image/webp" in self.headers.get("Accept", "") else "png"
+                image_mime = get_mime(ff_target_format)
             else:
-                image_extension: str = path.splitext(imagefile)[1].lstrip(".")
+                image_extension = path.splitext(imagefile)[1].lstrip(".")
                 image_mime = get_mime(image_extension)
             if image_mime is None:
                 self.return_unsupported_mime(image_extension)
                 return
+            try:
+                archive: CbzArchive = get_cbz_archive(file)
+            except PermissionError:
+                # i dont see a easy way to return a error as image without extensive libs or storing it to RAM
+                self.send_body(b"", MIME_TEXT, 500)
+                return
+            if imagefile not in archive.members:
+                self.send_body(b"", MIME_TEXT, 404)
+                return
+            transcode: Optional[Tuple[int, str]] = None
+            if transcode_quality and (ff_target_format is not None or image_extension.lower() in THUMBNAIL_SOURCE_EXTENSIONS):
+                transcode = self.transcode_target(query)
+            etag: str = archive.member_etag(imagefile, f"{transcode[0]}-{transcode[1]}" if transcode else ff_target_format)
+            if self.send_not_modified(etag, archive.mtime, CBZ_IMAGE_CACHE_CONTROL):
+                return
+            if transcode is not None:
+                if self.send_transcoded_member(file, archive, imagefile, etag, *transcode):
+                    return
+                etag = archive.member_etag(imagefile, ff_target_format)
             self.send_response(200)
             self.send_header("Content-Type", image_mime)
-            self.send_header("Last-Modified", last_edited)
+            self.send_header("Last-Modified", email.utils.formatdate(archive.mtime, usegmt=True))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", CBZ_IMAGE_CACHE_CONTROL)
+            if transcode_quality:
+                self.send_header("Vary", ", ".join(["Accept", *CLIENT_HINTS]))
+            if ff_target_format is not None:
+                if not transcode_quality:
+                    self.send_header("Vary", "Accept")
+                image: bytes = page_cache.get_or_create(
+                    f"{file}\0{archive.mtime_ns}\0{imagefile}\0{ff_target_format}",
+                    lambda: run_cpu_bound(ff_bz2_to_image, archive.zip.read(imagefile), ff_target_format),
+                )
+                self.send_header("Content-Length", str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+                return
+            self.send_header("Content-Length", str(archive.zip.getinfo(imagefile).file_size))
             self.end_headers()
+            self.send_cbz_member(file, archive, imagefile)
+            return
+
+        if thumbnail_width and "thumb" in query:
             try:
-                with ZipFile(file, "r") as zip_ref:
-                    self.wfile.write(ff_bz2_to_png(zip_ref.read(imagefile)) if ff else zip_ref.read(imagefile))
+                archive = get_cbz_archive(file)
             except PermissionError:
-                # i dont see a easy way to return a error as image without extensive libs or storing it to RAM
-                pass
+                self.send_body(b"", MIME_TEXT, 500)
+                return
+            if not archive.images:
+                self.send_body(b"", MIME_TEXT, 404)
+                return
+            first_page: str = archive.images[0]
+            self.send_thumbnail(
+                file,
+                archive.mtime_ns,
+                archive.etag,
+                query["thumb"][0],
+                lambda: (bz2.decompress if first_page.endswith(".ff.bz2") else bytes)(archive.zip.read(first_page)),
+                f"{parsedurl.path}?{urlencode({'image': first_page})}",
+            )
             return
 
-        images: List[str] = []
         try:
-            with ZipFile(file, "r") as zip_ref:
-                images = [
-                    i.filename
-                    for i in zip_ref.filelist
-                    if get_index(i.filename.rsplit(".", 1), 1) in IMAGE_FILE_EXTENSIONS or i.filename.endswith(".ff.bz2")
-                ]
+            images: List[str] = get_cbz_images(file)
         except PermissionError:
-            self.send_response(500)
-            self.send_header("Content-Type", MIME_TEXT)
-            self.end_headers()
-            self.wfile.write(b'Unable to display file: server has insufficient permissions to read it')
+            self.send_body(b'Unable to display file: server has insufficient permissions to read it', MIME_TEXT, 500)
             return
-        self.send_response(200)
-        self.send_header("Content-Type", MIME_HTML)
         # no clientside cache (both unlikely and would create issues when the next chapter releases)
-        self.end_headers()
-        images.sort(key=_sort_human_key)
         thispath = html.escape(parsedurl.path)
 
-        # calculate next chapter
-        dir, filename = path.split(file)
-        dircontent: List[str] = [i for i in listdir(dir) if i not in FILES_TO_NOT_INDEX]
-        dircontent.sort(key=_sort_human_key)
-        index_of_this: int = dircontent.index(filename)
+        # neighbour chapters (O(1) via the cached listing of the directory)
+        previous_chapter: Optional[str] = None
         next_chapter: Optional[str] = None
-        if len(dircontent) > index_of_this + 1:
-            next_chapter = dircontent[index_of_this + 1]
+        try:
+            previous_chapter, next_chapter = get_directory_listing(path.dirname(file)).neighbours(path.basename(file))
+        except OSError:
+            pass
+
+        # let the browser warm the next chapter (and the server its central directory) while this one is read
+        head_links: List[str] = []
+        if previous_chapter:
+            head_links.append(f'<link rel="prev" href="{html.escape(previous_chapter)}">')
+        if next_chapter:
+            head_links.append(f'<link rel="next" href="{html.escape(next_chapter)}">')
+            head_links.append(f'<link rel="prefetch" href="{html.escape(next_chapter)}">')
+            # (the transcoded pages depend on the screen -> prefetching the originals would be a waste)
+            if next_chapter.lower().endswith(".cbz") and not transcode_quality:
+                try:
+                    next_images: List[str] = get_cbz_images(path.join(path.dirname(file), next_chapter))
+                except (OSError, BadZipFile):
+                    next_images = []
+                head_links.extend(
+                    f'<link rel="prefetch" href="{html.escape(next_chapter)}?image={html.escape(i)}">'
+                    for i in next_images[:PREFETCH_NEXT_CHAPTER_PAGES]
+                )
+
+        def srcset(image_url: str) -> str:
+            # transcoded versions for the browser to choose from (depending on the screen width and density)
+            if not transcode_quality:
+                return ""
+            candidates: str = ", ".join(f"{image_url}&amp;width={i} {i}w" for i in TRANSCODE_WIDTHS)
+            return f' srcset="{candidates}" sizes="min(100vw, {TRANSCODE_DISPLAY_WIDTH}px)"'
 
         images_html: str = "<br>".join((
-            f'''<img src="{thispath}?image={html.escape(i)}"{' loading="lazy"' if idx>10 else ""}>'''
+            f'''<img src="{thispath}?image={html.escape(i)}"{srcset(f"{thispath}?image={html.escape(i)}")}{' loading="lazy"' if idx>10 else ""}>'''
             for idx, i in enumerate(images)
         ))
 
-        self.wfile.write(f'''
-            {HTML_HEAD}
+        self.send_html(f'''
+            {HTML_HEAD_START}{"".join(head_links)}{HTML_HEAD_END}
                 <style>body{{margin-left:auto;margin-right:auto;width:fit-content;}}</style>
                 <h1 id="h1_cbz_title">{generate_html_pathstr(unquote(parsedurl.path))}</h1>
                 {images_html}
                 {f'<br><a href="{html.escape(next_chapter)}">{html.escape(next_chapter)}</a>' if next_chapter else ""}
                 <br><br><br><a href="#h1_cbz_title" id="to_top_button">Go to top</a>
             {HTML_TAIL}
-        '''.encode(encoding="utf-8", errors="replace"))
+        ''', headers={"Accept-CH": ", ".join(CLIENT_HINTS)} if transcode_quality else None)
+
+    def send_cbz_member(self, file: str, archive: "CbzArchive", member: str) -> None:
+        data_offset: Optional[int] = archive.stored_data_offset(member)
+        if data_offset is not None:
+            # stored (uncompressed) -> stream the raw bytes straight from the cbz
+            with open(file, "rb") as f:
+                self.send_file_contents(f, data_offset, archive.zip.getinfo(member).file_size)
+            return
+        with archive.zip.open(member, "r") as member_handle:
+            shutil.copyfileobj(member_handle, self.wfile, COPY_CHUNK_SIZE)
+
+    def transcode_target(self, query: Dict[str, List[str]]) -> Optional[Tuple[int, str]]:
+        # -> (width, format) the page should be transcoded to, None: send the original
+        # ?width= wins over the client hints, ?width=0 requests the original
+        if "width" in query:
+            requested: float = parse_int(query["width"][0], 0)
+        else:
+            requested = parse_float(self.headers.get("Sec-CH-Width") or self.headers.get("Width"), 0.0)
+            if not requested:
+                viewport_width: float = parse_float(self.headers.get("Sec-CH-Viewport-Width") or self.headers.get("Viewport-Width"), 0.0)
+                requested = viewport_width * parse_float(self.headers.get("Sec-CH-DPR") or self.headers.get("DPR"), 1.0)
+        if requested <= 0:
+            return None
+        width: int = next((i for i in TRANSCODE_WIDTHS if i >= requested), TRANSCODE_WIDTHS[-1])
+        return width, "webp" if "image/webp" in self.headers.get("Accept", "") else "jpeg"
+
+    def send_transcoded_member(self, file: str, archive: "CbzArchive", member: str, etag: str, width: int, image_format: str) -> bool:
+        # -> False if the original should be sent instead (smaller than the transcoded version or not transcodable)
+        def transcode() -> bytes:
+            source: bytes = archive.zip.read(member)
+            if member.endswith(".ff.bz2"):
+                source = bz2.decompress(source)
+            result: bytes = run_cpu_bound(make_thumbnail, source, width, image_format, transcode_quality, TRANSCODE_MAX_HEIGHT)
+            return result if len(result) < archive.zip.getinfo(member).file_size else b""  # b"": keep the original
+
+        try:
+            image: bytes = transcode_cache.get_or_create(
+                f"{file}\0{archive.mtime_ns}\0{member}\0{width}\0{image_format}",
+                lambda: transcode_pool.submit(transcode).result(),
+            )
+        except Exception as e:
+            self.log_error("unable to transcode %s of %s: %r", member, file, e)
+            return False
+        if not image:
+            return False
+        self.send_response(200)
+        self.send_header("Content-Type", get_mime(image_format) or "")
+        self.send_header("Content-Length", str(len(image)))
+        self.send_header("Last-Modified", email.utils.formatdate(archive.mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CBZ_IMAGE_CACHE_CONTROL)
+        self.send_header("Vary", ", ".join(["Accept", *CLIENT_HINTS]))
+        self.end_headers()
+        self.wfile.write(image)
+        return True
 
     def handle_query(self, parsedurl: ParseResult, target_file: str) -> None:
         query_string: Dict[str, List[str]] = parse_qs(parsedurl.query)
         if not query_string:
             self.send_query_page(parsedurl, target_file)
             return
-        wanted: List[str] = [k.strip() for k, v in query_string.items() if "wanted" in v]
-        unwanted: List[str] = [k.strip() for k, v in query_string.items() if "unwanted" in v]
-        del query_string
-        tagfiles: List[str] = find_all_tagfile_paths(target_file[:-len(QUERY_URL_SUFFIX)])
-        matching_dirs: List[str] = []
-        for tagfile in tagfiles:
-            tags = read_tagfile(tagfile)
-            if any((tag in unwanted for tag in tags)):
-                continue
-            # any is faster than all -> inverse
-            if any((wanted_tag not in tags for wanted_tag in wanted)):
-                continue
-            matching_dirs.append(tagfile.rsplit("/", 1)[0])
-        self.send_response(200)
-        self.send_header("Content-Type", MIME_HTML)
-        self.end_headers()
-        files_html: List[str] = []
-        sent_images: int = 0
-        for dir_path in matching_dirs:
-            html_path: str = html.escape(path.relpath(dir_path, path.curdir))
-            dir_picture: str = next((
-                f'''<img src="/{html_path}/{img_file_name}"{' loading="lazy"' if sent_images > 10 else ""}><div class="st">{html.escape(dir_path)}</div>'''
-                for img_file_name in (f"folder.{i}" for i in IMAGE_FILE_EXTENSIONS)
-                if path.isfile(path.join(dir_path, img_file_name))
-            ), "")
-            if dir_picture:
-                sent_images += 1
-            files_html.append(f'<li><a href="/{html_path}">{dir_picture or html_path}</a></li>')
-        files_html.sort(key=_sort_human_key)
-        self.wfile.write(f'''
+        tag_query: TagQuery = TagQuery.from_query_string(query_string)
+        limit: int = parse_int(get_index(query_string.get("limit", []), 0), search_page_size)
+        page: int = max(parse_int(get_index(query_string.get("page", []), 0), 1), 1)
+        index: TagIndex = get_tag_index()
+        matching_dirs: List[str] = index.search(target_file[:-len(QUERY_URL_SUFFIX)], tag_query)
+        result_count: int = len(matching_dirs)
+        matching_dirs, page_count = paginate(matching_dirs, page, limit)
+
+        def page_link(target_page: int, label: str) -> str:
+            link_query: Dict[str, List[str]] = {**query_string, "page": [str(target_page)]}
+            return f'<a href="{html.escape(parsedurl.path)}?{html.escape(urlencode(link_query, doseq=True))}">{label}</a>'
+
+        # tags which occur in some (but not all) results, to narrow the search down
+        _, tags = index.tag_counts(target_file[:-len(QUERY_URL_SUFFIX)], tag_query) if result_count > 1 else (0, {})
+        facets: List[str] = [
+            '<a href="{}?{}">{}</a> ({})'.format(
+                html.escape(parsedurl.path),
+                html.escape(urlencode({**{k: v for k, v in query_string.items() if k != "page"}, tag: ["wanted"]}, doseq=True)),
+                html.escape(tag),
+                count,
+            )
+            for tag, count in sorted(tags.items(), key=lambda i: (-i[1], i[0]))
+            if tag and count < result_count
+        ][:MAX_FACETS]
+
+        pagination: str = "" if page_count < 2 else " ".join((
+            page_link(page - 1, "Previous") if page > 1 else "",
+            f"Page {page}/{page_count}",
+            page_link(page + 1, "Next") if page < page_count else "",
+        ))
+
+        def render() -> Iterator[str]:
+            yield f'''
             {HTML_HEAD}
                 <nav><a href="javascript:window.history.back();">Back</a></nav>
-                <h1>Search Results within {generate_html_pathstr(parsedurl.path[:-len(QUERY_URL_SUFFIX)])}</h1>({len(matching_dirs)} results)
-                <ul>{"".join(files_html)}</ul>
+                <h1>Search Results within {generate_html_pathstr(parsedurl.path[:-len(QUERY_URL_SUFFIX)])}</h1>({result_count} results)
+                {f"<p>Refine: {', '.join(facets)}</p>" if facets else ""}
+                {pagination}
+                <ul>'''
+            sent_images: int = 0
+            for dir_path in matching_dirs:
+                html_path: str = html.escape(path.relpath(dir_path, path.curdir))
+                cover: Optional[str] = find_cover(dir_path)
+                dir_picture: str = (
+                    f'''<img src="/{html_path}/{cover}{thumbnail_query(cover)}"{' loading="lazy"' if sent_images > 10 else ""}><div class="st">{html.escape(dir_path)}</div>'''
+                    if cover else ""
+                )
+                if dir_picture:
+                    sent_images += 1
+                yield f'<li><a href="/{html_path}">{dir_picture or html_path}</a></li>'
+            yield f'''</ul>
+                {pagination}
                 <br><br><br><a href="#h1_cbz_title" id="to_top_button">Go to top</a>
             {HTML_TAIL}
-        '''.encode(encoding="utf-8", errors="replace"))
+        '''
 
-    def send_query_page(self, parsedurl: ParseResult, target_file: str) -> None:
+        self.send_html_stream(render())
+
+    def handle_api(self, parsedurl: ParseResult) -> None:
+        query: Dict[str, List[str]] = parse_qs(parsedurl.query)
+        url_path: str = "/" + get_query_value(parsedurl, "path").strip("/")
+        target: str = path.abspath(path.join(path.curdir, url_path.lstrip("/")))
+        if not target.startswith(path.abspath(path.curdir)):
+            self.send_body(b"", MIME_TEXT, 403)
+            return
+        endpoint: str = parsedurl.path[len(API_URL_PREFIX):].strip("/")
+        data: Any
+        try:
+            if endpoint == "list":
+                listing: DirectoryListing = get_directory_listing(target)
+                data = {"path": url_path, "entries": [{
+                    "name": i.name,
+                    "url": f"{url_path.rstrip('/')}/{i.name}",
+                    "type": "file" if i.mtime_ns is None else "directory",
+                    "picture": i.picture_url(url_path.rstrip("/")),
+                } for i in listing.entries]}
+            elif endpoint == "tags":
+                tagfile_count, tags = get_tag_index().tag_counts(target)
+                data = {"path": url_path, "tagfile_count": tagfile_count, "tags": {k: v for k, v in sorted(tags.items()) if k}}
+            elif endpoint == "search":
+                tag_query: TagQuery = TagQuery.parse(",".join(query.get("q", [])))
+                tag_query.required += [[i] for i in query.get("wanted", [])]
+                tag_query.excluded += query.get("unwanted", [])
+                tag_query.preferred += query.get("preferred", [])
+                index: TagIndex = get_tag_index()
+                matching_dirs: List[str] = index.search(target, tag_query)
+                page: int = max(parse_int(get_index(query.get("page", []), 0), 1), 1)
+                results, page_count = paginate(matching_dirs, page, parse_int(get_index(query.get("limit", []), 0), search_page_size))
+                data = {"path": url_path, "count": len(matching_dirs), "page": page, "page_count": page_count, "facets": index.tag_counts(target, tag_query)[1], "results": [{
+                    "url": "/" + path.relpath(i, path.curdir),
+                    "picture": (lambda cover: f"/{path.relpath(i, path.curdir)}/{cover}{thumbnail_query(cover)}" if cover else None)(find_cover(i)),
+                } for i in results]}
+            elif endpoint == "chapter":
+                if not path.isfile(target):
+                    raise FileNotFoundError(target)  # (the parent of a directory could even be outside of the library)
+                previous_chapter, next_chapter = get_directory_listing(path.dirname(target)).neighbours(path.basename(target))
+                parent_url: str = url_path.rsplit("/", 1)[0]
+                pages: List[Dict[str, Any]]
+                if pdf_renderer and target.lower().endswith(".pdf"):
+                    pages = [{"name": str(i), "size": None, "url": f"{url_path}?page={i}"} for i in range(1, get_pdf_page_count(target) + 1)]
+                else:
+                    archive: CbzArchive = get_cbz_archive(target)
+                    pages = [{
+                        "name": i,
+                        "size": archive.zip.getinfo(i).file_size,
+                        "url": f"{url_path}?{urlencode({'image': i})}",
+                    } for i in archive.images]
+                data = {
+                    "path": url_path,
+                    "page_count": len(pages),
+                    "pages": pages,
+                    "previous": f"{parent_url}/{previous_chapter}" if previous_chapter else None,
+                    "next": f"{parent_url}/{next_chapter}" if next_chapter else None,
+                }
+            else:
+                self.send_body(b'{"error": "unknown endpoint"}', MIME_JSON, 404)
+                return
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError, BadZipFile, PdfError):
+            self.send_body(b'{"error": "not found"}', MIME_JSON, 404)
+            return
+        except PermissionError:
+            self.send_body(b'{"error": "insufficient permissions"}', MIME_JSON, 500)
+            return
+        body: bytes = json.dumps(data, separators=(",", ":")).encode(encoding="utf-8")
+        etag: str = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        if self.send_not_modified(etag, None, "no-cache"):
+            return
+        self.send_body(body, MIME_JSON, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    def send_html(self, body: str, status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_body(body.encode(encoding="utf-8", errors="replace"), MIME_HTML, status, headers)
+
+    def send_body(self, body: bytes, mime: str, status: int = 200, headers: Optional[Dict[str, str]] = None) -> None:
+        # compressed if the client supports it (the compressed version gets memoised)
+        encoding: Optional[str] = negotiate_encoding(self.headers.get("Accept-Encoding", "")) if len(body) >= MIN_COMPRESS_SIZE else None
+        if encoding is not None:
+            body = compress_memoised(body, encoding)
+        self.send_response(status)
+        self.send_header("Content-Type", mime)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        with timed("write"):
+            self.wfile.write(body)
+
+    def send_html_stream(self, parts: Iterable[str]) -> None:
+        # send a page while it is still being rendered (chunked for HTTP/1.1 clients, until connection-close otherwise)
+        # the first part (head, title, ..) is sent right away, the rest in blocks of STREAM_BLOCK_SIZE
+        chunked: bool = self.request_version == "HTTP/1.1"
+        encoding: Optional[str] = negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+        compressor: Optional[StreamCompressor] = StreamCompressor(encoding) if encoding is not None else None
         self.send_response(200)
         self.send_header("Content-Type", MIME_HTML)
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
         self.end_headers()
-        tagfiles: List[str] = find_all_tagfile_paths(target_file[:-len(QUERY_URL_SUFFIX)])
-        tags: Dict[str, int] = {}
-        for filepath in tagfiles:
-            for tag in read_tagfile(filepath):
-                tags[tag] = (tags.get(tag) or 0) + 1
+
+        def write_raw(encoded: bytes) -> None:
+            if not encoded:
+                return
+            if chunked:
+                self.wfile.write(f"{len(encoded):x}\r\n".encode() + encoded + b"\r\n")
+            else:
+                self.wfile.write(encoded)
+
+        def write(data: str) -> None:
+            encoded: bytes = data.encode(encoding="utf-8", errors="replace")
+            write_raw(compressor.compress(encoded) if compressor is not None else encoded)
+
+        buffer: List[str] = []
+        buffered: int = 0
+        for idx, part in enumerate(parts):
+            buffer.append(part)
+            buffered += len(part)
+            if idx == 0 or buffered >= STREAM_BLOCK_SIZE:
+                write("".join(buffer))
+                self.wfile.flush()  # (buffered writers, e.g. SERVER=asyncio, would hold it back)
+                buffer.clear()
+                buffered = 0
+        if buffer:
+            write("".join(buffer))
+        if compressor is not None:
+            write_raw(compressor.finish())
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def send_query_page(self, parsedurl: ParseResult, target_file: str) -> None:
+        tagfile_count, tags = get_tag_index().tag_counts(target_file[:-len(QUERY_URL_SUFFIX)])
         tag_names: List[str] = list(tags.keys())
         tag_names.sort()
-        pm: float = float(len(tagfiles)) / 100.0
+        pm: float = float(tagfile_count) / 100.0
         tags_html: str = "".join((
             f'''
             <tr>
                 <td><input type="radio" name="{html.escape(tag)}" value="ignore" checked="checked"></td>
                 <td><input type="radio" name="{html.escape(tag)}" value="wanted"></td>
                 <td><input type="radio" name="{html.escape(tag)}" value="unwanted"></td>
+                <td><input type="radio" name="{html.escape(tag)}" value="preferred"></td>
                 <td>{html.escape(tag)} ({tags[tag]}; {floor(tags[tag] / pm)}%)</td>
             </tr>
             '''
             for tag in tag_names if tag
         ))
-        self.wfile.write(f'''
+        self.send_html(f'''
             {HTML_HEAD}
                 <nav><a href="javascript:window.history.back();">Back</a></nav>
                 <h1>Search within {generate_html_pathstr(parsedurl.path[:-len(QUERY_URL_SUFFIX)])}</h1>
                 <form action="{html.escape(parsedurl.path)}">
+                    <input type="text" name="q" placeholder="Comedy, Action|Adventure, -Horror, Isekai*, ~Romance">
                     <table>
-                        <tr><th>Allow</th><th>Enforce</th><th>Block</th><th>Tag</th></tr>
+                        <tr><th>Allow</th><th>Enforce</th><th>Block</th><th>Prefer</th><th>Tag</th></tr>
                         {tags_html}
                     </table>
                     <input type="submit" value="Search">
                 </form>
                 <a href="{parsedurl.path}/clear_serverside_cache">Clear serverside cache</a>
             {HTML_TAIL}
-        '''.encode(encoding="utf-8", errors="replace"))
+        ''')
 
     def return_unsupported_mime(self, extension: str) -> None:
-        self.send_response(415)  # unsupported media type
-        self.send_header("Content-Type", MIME_TEXT)
-        self.end_headers()
-        self.wfile.write(f"file extension {extension} is not supported.".encode(encoding="utf-8", errors="replace"))
+        self.send_body(f"file extension {extension} is not supported.".encode(encoding="utf-8", errors="replace"), MIME_TEXT, 415)  # unsupported media type
 
     def send_index(self, target_file: str, parsedurl: ParseResult) -> None:
-        files: List[str] = []
-        thispath: str = html.escape(parsedurl.path)
+        items: Iterable[str] = ()
         filecount: int = 0
         if path.isdir(target_file):
             try:
-                raw_files: List[str] = listdir(target_file)
+                listing: DirectoryListing = get_directory_listing(target_file)
             except PermissionError:
-                self.send_response(500)
-                self.send_header("Content-Type", MIME_TEXT)
-                self.end_headers()
-                self.wfile.write(b'Unable to generate directory index: server is missing read and/or list permissions.')
+                self.send_body(b'Unable to generate directory index: server is missing read and/or list permissions.', MIME_TEXT, 500)
                 return
-            raw_files = [i for i in raw_files if i not in FILES_TO_NOT_INDEX and not path.exists(path.join(target_file, i, ".ignore"))]
-            filecount = len(raw_files)
+            filecount = len(listing.entries)
 
-            if len(raw_files) == 1:
-                self.send_response(307)  # temporary redirect
-                self.send_header("Location", f"{parsedurl.path}/{raw_files[0]}")
-                self.end_headers()
+            if filecount == 1:
+                self.send_body(b"", MIME_TEXT, 307, {"Location": f"{parsedurl.path}/{listing.entries[0].name}"})  # temporary redirect
                 return
 
-            raw_files.sort(key=_sort_human_key)
-            sent_images: int = 0
-            for file in raw_files:
-                dir_picture: str = next((
-                    f'''<img src="{thispath}/{html.escape(file)}/{img_file_name}"{' loading="lazy"' if sent_images > 10 else ""} alt="{html.escape(file)}"><div class="st">{html.escape(file)}</div>'''
-                    for img_file_name in (f"folder.{i}" for i in IMAGE_FILE_EXTENSIONS)
-                    if path.isfile(f"{target_file}/{file}/{img_file_name}")
-                ), "") if path.isdir(f"{target_file}/{file}") else ""
-                files.append(f'<li><a href="{thispath}/{html.escape(file)}">{dir_picture or html.escape(file)}</a></li>')
-                if dir_picture:
-                    sent_images += 1
-        self.send_response(200)
-        self.send_header("Content-Type", MIME_HTML)
-        self.end_headers()
-        self.wfile.write(f'''
+            items = listing.iter_items_html(parsedurl.path)
+
+        def render() -> Iterator[str]:
+            yield f'''
             {HTML_HEAD}
                 <nav><a href="{html.escape(parsedurl.path)}{QUERY_URL_SUFFIX}">Search</a></nav>
                 <h1 id="h1_index_title">{generate_html_pathstr(unquote(parsedurl.path))}</h1>({filecount} results)
-                <ul>{"".join(files)}</ul>
+                <ul>'''
+            yield from items
+            yield f'''</ul>
                 <a href="#h1_index_title" id="to_top_button">Go to top</a>
             {HTML_TAIL}
-        '''.encode(encoding="utf-8", errors="replace"))
+        '''
+
+        self.send_html_stream(render())
+
+# alternative server core (SERVER=asyncio): connections wait within the event-loop (HTTP/1.1 keep-alive, pipelined
+# requests get answered in order), only requests being handled occupy one of the threads running the usual RequestHandler
+class AsyncHTTPServer:
+    def __init__(self, server_address: tuple, threads: int, handler: Optional[Callable] = None) -> None:
+        self.threads: int = threads
+        self.handler: Callable = handler or KeepAliveRequestHandler
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="cbzerv")
+        self.pending: int = 0  # accepted requests which are not finished yet (running + queued), only changed by the loop
+        self.connections: int = 0
+        self._last_saturation_report: float = 0.0
+        import asyncio
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self._stopped: asyncio.Future = self.loop.create_future()
+        # listens right away (like HTTPServer)
+        self._server: "asyncio.AbstractServer" = self.loop.run_until_complete(
+            asyncio.start_server(self._serve_connection, *server_address, limit=MAX_REQUEST_HEAD)
+        )
+        self.server_address: tuple = self._server.sockets[0].getsockname()[:2]  # type: ignore
+
+    def serve_forever(self) -> None:
+        self.loop.run_until_complete(self._stopped)
+
+    def shutdown(self) -> None:
+        self.loop.call_soon_threadsafe(lambda: self._stopped.done() or self._stopped.set_result(None))
+
+    def server_close(self) -> None:
+        self._server.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve_connection(self, reader: "asyncio.StreamReader", writer: "asyncio.StreamWriter") -> None:
+        import asyncio
+        self.connections += 1
+        client_address: tuple = writer.get_extra_info("peername")[:2]
+        try:
+            while True:
+                try:
+                    head: bytes = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    return  # closed by the client, idle for too long or a way too long head
+                head = head.lstrip(b"\r\n")  # empty lines in front of a request have to be ignored
+                if not head:
+                    continue
+                self.pending += 1
+                queued: int = self.pending - self.threads
+                if queued > 0 and monotonic() - self._last_saturation_report > 1.0:
+                    self._last_saturation_report = monotonic()
+                    sys.stderr.write(f"server saturated: {queued} request(s) queued ({self.threads} threads busy)\n")
+                try:
+                    keep_alive: bool = await self.loop.run_in_executor(self.executor, self._handle_request, head, writer, client_address)
+                finally:
+                    self.pending -= 1
+                # no endpoint reads request bodies -> closing is the easiest way to not mistake one for the next request
+                if not keep_alive or re.search(rb"\r\n(content-length: *[1-9]|transfer-encoding:)", head, re.IGNORECASE):
+                    return
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def _handle_request(self, head: bytes, writer: "asyncio.StreamWriter", client_address: tuple) -> bool:
+        # runs within the executor -> whether the connection can be kept alive
+        try:
+            handler: KeepAliveRequestHandler = self.handler(head, LoopWriter(writer, self.loop), client_address, self)
+        except ConnectionError:
+            return False
+        except Exception:
+            import traceback
+            sys.stderr.write(f"{'-' * 40}\nException occurred during processing of request from {client_address}\n")
+            traceback.print_exc()
+            sys.stderr.write("-" * 40 + "\n")
+            return False
+        return not handler.close_connection
+
+
+# file-like object for a handler-thread writing to a connection of the event-loop
+# writes are handed over in blocks, the thread waits while the client is slow (backpressure)
+class LoopWriter:
+    def __init__(self, writer: "asyncio.StreamWriter", loop: "asyncio.AbstractEventLoop") -> None:
+        self._writer: "asyncio.StreamWriter" = writer
+        self._loop: "asyncio.AbstractEventLoop" = loop
+        self._buffer: bytearray = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        if len(self._buffer) >= COPY_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        data: bytes = bytes(self._buffer)
+        self._buffer.clear()
+        if len(data) < COPY_CHUNK_SIZE:
+            # small: no need to wait for the client (still in order, everything gets scheduled on the loop)
+            self._loop.call_soon_threadsafe(self._writer.write, data)
+            return
+        self._run(self._send(data), SEND_TIMEOUT)
+
+    def sendfile(self, file_handle: BinaryIO, offset: int, count: int) -> int:
+        # zero-copy if possible (falls back to read + write otherwise, e.g. ssl)
+        self.flush()
+        return self._run(self._loop.sendfile(self._writer.transport, file_handle, offset, count), None)
+
+    async def _send(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def _run(self, coroutine: Any, timeout: Optional[float]) -> Any:
+        import asyncio
+        future: Future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+
+# RequestHandler for a single request of an AsyncHTTPServer connection (the head gets read by the event-loop)
+class KeepAliveRequestHandler(RequestHandler):
+    keep_alive = True
+
+    def __init__(self, request_head: bytes, wfile: LoopWriter, client_address: tuple, server: AsyncHTTPServer) -> None:
+        self.rfile = io.BytesIO(request_head)
+        self.loop_writer: LoopWriter = wfile
+        self.wfile = CountingWriter(wfile) if metrics is not None else wfile
+        self.client_address = client_address
+        self.server = server  # type: ignore
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+        finally:
+            self.wfile.flush()  # handle_one_request does not flush after send_error
+
+    def end_headers(self) -> None:
+        # a body without Content-Length (or chunked encoding) ends with the connection
+        head: bytes = b"".join(getattr(self, "_headers_buffer", []))
+        if not self.close_connection and self.status not in (204, 304) and not re.search(
+            rb"\r\n(content-length|transfer-encoding):", head, re.IGNORECASE,
+        ):
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def send_file_contents(self, file_handle: BinaryIO, offset: int, count: int) -> None:
+        self.wfile.flush()
+        with timed("sendfile"):
+            sent: int = self.loop_writer.sendfile(file_handle, offset, count)
+        if isinstance(self.wfile, CountingWriter):
+            self.wfile.written += sent
+
+
+# incremental gzip/ brotli compression (flushed after every block so streamed pages stay streamed)
+class StreamCompressor:
+    def __init__(self, encoding: str) -> None:
+        self.encoding: str = encoding
+        self._compressor: Any = brotli.Compressor(quality=BROTLI_QUALITY) if encoding == "br" else zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+# a parsed tag search: every group of `required` needs one matching term, `excluded` terms must not match
+# and `preferred` terms only rank the results; terms ending with * match every tag with that prefix
+class TagQuery:
+    def __init__(self) -> None:
+        self.required: List[List[str]] = []
+        self.excluded: List[str] = []
+        self.preferred: List[str] = []
+
+    @staticmethod
+    def parse(text: str) -> "TagQuery":
+        # comma-separated terms, e.g. "Comedy, Action|Adventure, -Horror, Isekai*, ~Romance"
+        result: TagQuery = TagQuery()
+        for term in text.split(","):
+            term = term.strip()
+            if term.startswith("-") and term[1:].strip():
+                result.excluded.append(term[1:].strip())
+            elif term.startswith("~") and term[1:].strip():
+                result.preferred.append(term[1:].strip())
+            elif term.strip("-~|"):
+                result.required.append([i.strip() for i in term.split("|") if i.strip()])
+        return result
+
+    @staticmethod
+    def from_query_string(query_string: Dict[str, List[str]]) -> "TagQuery":
+        # ?q=... and/or the tag=wanted|unwanted|preferred radio buttons of the search page
+        result: TagQuery = TagQuery.parse(",".join(query_string.get("q", [])))
+        for key, values in query_string.items():
+            if "wanted" in values:
+                result.required.append([key.strip()])
+            elif "unwanted" in values:
+                result.excluded.append(key.strip())
+            elif "preferred" in values:
+                result.preferred.append(key.strip())
+        return result
+
+    def __bool__(self) -> bool:
+        return bool(self.required or self.excluded or self.preferred)
+
+
+# (directory, mtime_ns, tagfile mtime_ns, tags)
+TagIndexRow = Tuple[str, int, Optional[int], Optional[List[str]]]
+
+
+# in-memory index of all tagfiles below `root` (tag -> posting set of directories)
+# built once and kept up to date by re-checking directory and tagfile mtimes (at most every `refresh_interval` seconds)
+class TagIndex:
+    def __init__(self, root: str, refresh_interval: float = 5.0, state: Optional[List[TagIndexRow]] = None) -> None:
+        self.root: str = root.rstrip(sep) or sep
+        self.refresh_interval: float = refresh_interval
+        self.dirty: bool = False  # changed since the last export_state
+        self._lock: RLock = RLock()
+        self._dir_mtimes: Dict[str, int] = {}  # every directory below root -> mtime_ns
+        self._tagfile_mtimes: Dict[str, int] = {}  # tagged directory -> mtime_ns of its tagfile
+        self._tags: Dict[str, List[str]] = {}  # tagged directory -> tags
+        # tagged directories are numbered, so the postings can be bitsets (plain ints) over these numbers
+        self._dir_ids: Dict[str, int] = {}  # tagged directory -> number
+        self._dir_names: List[Optional[str]] = []  # number -> tagged directory (None: unused)
+        self._dir_sort_keys: List[tuple] = []  # number -> _sort_human_key of the directory
+        self._free_ids: List[int] = []
+        self._tagged: int = 0  # every tagged directory
+        self._postings: Dict[str, int] = {}  # tag -> tagged directories
+        self._sorted_tags: Optional[List[str]] = None  # for prefix lookups, None after tags were added/ removed
+        self._subtree_masks: Dict[str, int] = {}  # basedir -> tagged directories below it, cleared on changes
+        self._last_refresh: float = 0.0
+        if state:
+            # answer from the saved state right away, it gets validated by the next refresh
+            for directory, mtime, tagfile_mtime, tags in state:
+                self._dir_mtimes[directory] = mtime
+                if tagfile_mtime is not None and tags is not None:
+                    self._tagfile_mtimes[directory] = tagfile_mtime
+                    self._set_tags(directory, tags)
+            self._last_refresh = monotonic()
+        else:
+            self.rescan()
+
+    def export_state(self) -> List[TagIndexRow]:
+        with self._lock:
+            self.dirty = False
+            return [
+                (directory, mtime, self._tagfile_mtimes.get(directory), self._tags.get(directory))
+                for directory, mtime in self._dir_mtimes.items()
+            ]
+
+    def rescan(self) -> None:
+        with self._lock, timed("index_rescan"):
+            self._dir_mtimes.clear()
+            self._tagfile_mtimes.clear()
+            self._tags.clear()
+            self._dir_ids.clear()
+            self._dir_names.clear()
+            self._dir_sort_keys.clear()
+            self._free_ids.clear()
+            self._tagged = 0
+            self._postings.clear()
+            self._sorted_tags = None
+            self._subtree_masks.clear()
+            self._scan_tree(self.root)
+            self._last_refresh = monotonic()
+            self.dirty = True
+
+    def refresh(self) -> List[str]:
+        # only subtrees with a changed mtime get re-listed
+        # -> directories which changed (or vanished)
+        changed: List[str] = []
+        with self._lock, timed("index_refresh"):
+            for directory, mtime in list(self._dir_mtimes.items()):
+                if directory not in self._dir_mtimes:
+                    continue  # parent got removed during this refresh
+                try:
+                    current_mtime: int = stat(directory).st_mtime_ns
+                except OSError:
+                    self._forget_tree(directory)
+                    changed.append(directory)
+                    continue
+                if current_mtime != mtime:
+                    changed.append(directory)
+                    for subdir in self._scan_dir(directory):
+                        if subdir not in self._dir_mtimes:
+                            self._scan_tree(subdir)
+                elif directory in self._tagfile_mtimes:
+                    # editing a tagfile in place does not change the directory mtime
+                    try:
+                        tagfile_mtime: int = stat(path.join(directory, TAGFILE_NAME)).st_mtime_ns
+                    except OSError:
+                        self._scan_dir(directory)
+                        continue
+                    if tagfile_mtime != self._tagfile_mtimes[directory]:
+                        self._scan_dir(directory)
+            self._last_refresh = monotonic()
+        return changed
+
+    def invalidate(self, directory: str) -> None:
+        # re-index a single directory (and new subdirectories), used by the filesystem watcher
+        with self._lock:
+            if directory not in self._dir_mtimes and not path.isdir(directory):
+                return
+            if not (directory == self.root or directory.startswith(self.root.rstrip(sep) + sep)):
+                return
+            for subdir in self._scan_dir(directory):
+                if subdir not in self._dir_mtimes:
+                    self._scan_tree(subdir)
+
+    def maybe_refresh(self) -> None:
+        if monotonic() - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def search(self, basedir: str, tag_query: "TagQuery") -> List[str]:
+        # -> matching directories, the ones with the most preferred tags first
+        with self._lock:
+            self.maybe_refresh()
+            with timed("tag_search"):
+                matches: List[int] = self._bits(self._match(basedir, tag_query))
+                sort_keys: List[tuple] = self._dir_sort_keys
+                if tag_query.preferred:
+                    scores: Dict[int, int] = {}
+                    for term in tag_query.preferred:
+                        for i in self._bits(self._term(term)):
+                            scores[i] = scores.get(i, 0) + 1
+                    matches.sort(key=lambda i: (-scores.get(i, 0), sort_keys[i]))
+                else:
+                    matches.sort(key=sort_keys.__getitem__)
+                return [self._dir_names[i] for i in matches]  # type: ignore
+
+    def tag_counts(self, basedir: str, tag_query: Optional["TagQuery"] = None) -> Tuple[int, Dict[str, int]]:
+        # -> (amount of (matching) tagfiles, tag -> amount of these directories with it)
+        with self._lock:
+            self.maybe_refresh()
+            mask: int = self._match(basedir, tag_query) if tag_query else self._subtree(basedir)
+            if not mask:
+                return 0, {}
+            return popcount(mask), {tag: count for tag, posting in self._postings.items() if (count := popcount(posting & mask))}
+
+    def _match(self, basedir: str, tag_query: "TagQuery") -> int:
+        mask: int = self._subtree(basedir)
+        for group in tag_query.required:
+            if not mask:
+                break
+            alternatives: int = 0
+            for term in group:
+                alternatives |= self._term(term)
+            mask &= alternatives
+        for term in tag_query.excluded:
+            mask &= ~self._term(term)
+        return mask
+
+    def _term(self, term: str) -> int:
+        # terms ending with * match every tag starting with the rest
+        if not term.endswith("*"):
+            return self._postings.get(term, 0)
+        prefix: str = term[:-1]
+        if self._sorted_tags is None:
+            self._sorted_tags = sorted(self._postings)
+        result: int = 0
+        for i in range(bisect_left(self._sorted_tags, prefix), len(self._sorted_tags)):
+            tag: str = self._sorted_tags[i]
+            if not tag.startswith(prefix):
+                break
+            result |= self._postings[tag]
+        return result
+
+    def _subtree(self, basedir: str) -> int:
+        if self._is_root(basedir):
+            return self._tagged
+        basedir = basedir.rstrip(sep)
+        mask: Optional[int] = self._subtree_masks.get(basedir)
+        if mask is None:
+            prefix: str = basedir + sep
+            bits: bytearray = bytearray((len(self._dir_names) + 7) // 8)
+            for directory, i in self._dir_ids.items():
+                if directory == basedir or directory.startswith(prefix):
+                    bits[i >> 3] |= 1 << (i & 7)
+            mask = int.from_bytes(bits, "little")
+            if len(self._subtree_masks) >= 1024:
+                self._subtree_masks.clear()
+            self._subtree_masks[basedir] = mask
+        return mask
+
+    def _is_root(self, basedir: str) -> bool:
+        return (basedir.rstrip(sep) or sep) == self.root
+
+    @staticmethod
+    def _bits(mask: int) -> List[int]:
+        return [i for i, bit in enumerate(bin(mask)[:1:-1]) if bit == "1"]
+
+    def _scan_tree(self, top: str) -> None:
+        stack: List[str] = [top]
+        while stack:
+            stack.extend(self._scan_dir(stack.pop()))
+
+    def _scan_dir(self, directory: str) -> List[str]:
+        # (re-)index a single directory and return its subdirectories
+        try:
+            mtime: int = stat(directory).st_mtime_ns
+            with scandir(directory) as entries:
+                names: Set[str] = set()
+                subdirs: List[str] = []
+                for entry in entries:
+                    names.add(entry.name)
+                    # same behaviour as os.walk: list symlinked directories, but do not descend into them
+                    if entry.is_dir() and not entry.is_symlink():
+                        subdirs.append(entry.path)
+        except OSError:
+            self._forget_tree(directory)
+            return []
+        self._dir_mtimes[directory] = mtime
+        self.dirty = True
+        tags: Optional[List[str]] = None
+        if TAGFILE_NAME in names and ".ignore" not in names:
+            tagfile: str = path.join(directory, TAGFILE_NAME)
+            try:
+                self._tagfile_mtimes[directory] = stat(tagfile).st_mtime_ns
+                tags = read_tagfile(tagfile)
+                if metrics is not None:
+                    metrics.count("tagfile_reads")
+            except OSError:
+                tags = None
+        self._set_tags(directory, tags)
+        return subdirs
+
+    def _set_tags(self, directory: str, tags: Optional[List[str]]) -> None:
+        old_tags: Optional[List[str]] = self._tags.pop(directory, None)
+        if old_tags is not None:
+            keep: int = ~(1 << self._dir_ids[directory])
+            for tag in old_tags:
+                posting: int = self._postings.get(tag, 0) & keep
+                if posting:
+                    self._postings[tag] = posting
+                elif self._postings.pop(tag, None) is not None:
+                    self._sorted_tags = None
+        if tags is None:
+            self._tagfile_mtimes.pop(directory, None)
+            if old_tags is not None:
+                self._release_id(directory)
+            return
+        tags = [sys.intern(tag) for tag in tags]
+        self._tags[directory] = tags
+        bit: int = 1 << self._intern_id(directory)
+        for tag in tags:
+            if tag not in self._postings:
+                self._sorted_tags = None
+            self._postings[tag] = self._postings.get(tag, 0) | bit
+
+    def _intern_id(self, directory: str) -> int:
+        dir_id: Optional[int] = self._dir_ids.get(directory)
+        if dir_id is not None:
+            return dir_id
+        if self._free_ids:
+            dir_id = self._free_ids.pop()
+        else:
+            dir_id = len(self._dir_names)
+            self._dir_names.append(None)
+            self._dir_sort_keys.append(())
+        self._dir_ids[directory] = dir_id
+        self._dir_names[dir_id] = directory
+        self._dir_sort_keys[dir_id] = _sort_human_key(path.relpath(directory, self.root))
+        self._tagged |= 1 << dir_id
+        self._subtree_masks.clear()
+        return dir_id
+
+    def _release_id(self, directory: str) -> None:
+        dir_id: int = self._dir_ids.pop(directory)
+        self._dir_names[dir_id] = None
+        self._tagged &= ~(1 << dir_id)
+        self._free_ids.append(dir_id)
+        self._subtree_masks.clear()
+
+    def _forget_tree(self, directory: str) -> None:
+        self.dirty = True
+        prefix: str = directory + sep
+        for i in [i for i in self._dir_mtimes if i == directory or i.startswith(prefix)]:
+            del self._dir_mtimes[i]
+            self._set_tags(i, None)
+
+
+# thread-safe LRU cache bounded by the amount of entries and their (estimated) size in bytes
+class BoundedLru:
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.current_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            entry: Optional[Tuple[Any, int]] = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Any, value: Any, size: int) -> None:
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        with self._lock:
+            old: Optional[Tuple[Any, int]] = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._data[key] = (value, size)
+            self.current_bytes += size
+            while len(self._data) > self.max_entries or self.current_bytes > self.max_bytes:
+                self.current_bytes -= self._data.popitem(last=False)[1][1]
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            old: Optional[Tuple[Any, int]] = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DirectoryEntry:
+    def __init__(self, name: str, mtime_ns: Optional[int], cover: Optional[str]) -> None:
+        self.name: str = name
+        self.mtime_ns: Optional[int] = mtime_ns  # None -> not a directory
+        self.cover: Optional[str] = cover  # filename of the folder.* image
+
+    def picture_url(self, parent_url: str) -> Optional[str]:
+        if self.cover:
+            return f"{parent_url}/{self.name}/{self.cover}{thumbnail_query(self.cover)}"
+        if thumbnail_width and self.mtime_ns is None and (self.name.lower().endswith(".cbz") or pdf_renderer and self.name.lower().endswith(".pdf")):
+            return f"{parent_url}/{self.name}{thumbnail_query(self.name)}"  # first page
+        return None
+
+
+# everything needed to render the index of a directory (sorted entries without ignored ones, covers, rendered html)
+# a directory mtime only changes when entries get added/ removed/ renamed -> subdirectories are checked as well
+# since adding a cover or `.ignore` only changes the mtime of the subdirectory
+class DirectoryListing:
+    def __init__(self, directory: str, stored: Optional[Tuple[int, List[Tuple[str, Optional[int], Optional[str]]]]] = None) -> None:
+        self.directory: str = directory
+        self._items_html: Dict[str, str] = {}  # url-path -> rendered <li> items
+        self._positions: Optional[Dict[str, int]] = None  # name -> index within entries
+        if stored is not None:
+            # from the library-store (has to be validated using is_current)
+            self.mtime_ns: int = stored[0]
+            self.entries: List[DirectoryEntry] = [DirectoryEntry(*i) for i in stored[1]]
+            self.memory: int = 512 + sum(200 + 2 * len(i.name) for i in self.entries)
+            return
+        self.mtime_ns = stat(directory).st_mtime_ns
+        self.entries = []
+        for name in listdir(directory):
+            if name in FILES_TO_NOT_INDEX:
+                continue
+            entry_path: str = path.join(directory, name)
+            try:
+                entry_stat: Optional[os.stat_result] = stat(entry_path)
+            except OSError:
+                entry_stat = None  # broken symlink, ..
+            if entry_stat is None or not S_ISDIR(entry_stat.st_mode):
+                self.entries.append(DirectoryEntry(name, None, None))
+                continue
+            if path.exists(path.join(entry_path, ".ignore")):
+                continue
+            self.entries.append(DirectoryEntry(name, entry_stat.st_mtime_ns, next((
+                i for i in FOLDER_IMAGE_NAMES if path.isfile(path.join(entry_path, i))
+            ), None)))
+        self.entries.sort(key=lambda i: _sort_human_key(i.name))
+        self.memory = 512 + sum(200 + 2 * len(i.name) for i in self.entries)
+
+    def neighbours(self, name: str) -> Tuple[Optional[str], Optional[str]]:
+        # -> (previous entry, next entry)
+        if self._positions is None:
+            self._positions = {entry.name: idx for idx, entry in enumerate(self.entries)}
+        idx: Optional[int] = self._positions.get(name)
+        if idx is None:
+            return None, None
+        return (
+            self.entries[idx - 1].name if idx > 0 else None,
+            self.entries[idx + 1].name if idx + 1 < len(self.entries) else None,
+        )
+
+    def is_current(self) -> bool:
+        try:
+            if stat(self.directory).st_mtime_ns != self.mtime_ns:
+                return False
+            return all(
+                stat(path.join(self.directory, i.name)).st_mtime_ns == i.mtime_ns
+                for i in self.entries if i.mtime_ns is not None
+            )
+        except OSError:
+            return False
+
+    def iter_items_html(self, url_path: str) -> Iterator[str]:
+        # yields the rendered <li> items (all at once if they are cached already)
+        cached: Optional[str] = self._items_html.get(url_path)
+        if cached is not None:
+            yield cached
+            return
+        thispath: str = html.escape(url_path)
+        files: List[str] = []
+        sent_images: int = 0
+        for entry in self.entries:
+            file: str = html.escape(entry.name)
+            picture_url: Optional[str] = entry.picture_url(url_path)
+            dir_picture: str = (
+                f'''<img src="{html.escape(picture_url)}"{' loading="lazy"' if sent_images > 10 else ""} alt="{file}"><div class="st">{file}</div>'''
+                if picture_url else ""
+            )
+            files.append(f'<li><a href="{thispath}/{file}">{dir_picture or file}</a></li>')
+            yield files[-1]
+            if dir_picture:
+                sent_images += 1
+        self._items_html[url_path] = "".join(files)
+
+
+listing_cache: BoundedLru = BoundedLru(256, 16 * 1024 * 1024)
+
+def get_directory_listing(directory: str) -> DirectoryListing:
+    cached: Optional[DirectoryListing] = listing_cache.get(directory)
+    if cached is not None and cached.is_current():
+        return cached
+    listing: Optional[DirectoryListing] = None
+    if library_store is not None and cached is None:
+        stored = library_store.get_listing(directory)
+        if stored is not None:
+            listing = DirectoryListing(directory, stored)
+            if not listing.is_current():
+                listing = None
+    if listing is None:
+        with timed("listing_scan"):
+            listing = DirectoryListing(directory)
+        if library_store is not None:
+            library_store.queue_listing(directory, listing.mtime_ns, [(i.name, i.mtime_ns, i.cover) for i in listing.entries])
+    # the rendered html is about as big as the entries (x2 for the memory estimate)
+    listing_cache.put(directory, listing, listing.memory * 2)
+    return listing
+
+
+# an opened cbz with its parsed central directory
+# evicted archives are not closed explicitly since another thread might still read from them (the GC closes them)
+class CbzArchive:
+    def __init__(self, file: str, mtime_ns: int, size: int) -> None:
+        self.zip: ZipFile = ZipFile(file, "r")
+        self.mtime_ns: int = mtime_ns
+        self.mtime: float = mtime_ns / 1e9
+        self.etag: str = make_etag(mtime_ns, size)
+        self.members: Set[str] = set(self.zip.NameToInfo.keys())
+        self.images: List[str] = sorted((i for i in self.members if is_image_member(i)), key=_sort_human_key)
+        # rough estimate of ZipInfo + strings (+ the open file-handle)
+        self.memory: int = 4096 + sum(400 + 2 * len(i) for i in self.members)
+        self._data_offsets: Dict[str, int] = {}
+
+    def member_etag(self, member: str, variant: Optional[str] = None) -> str:
+        return f'{self.etag[:-1]}-{self.zip.getinfo(member).CRC:x}{"-" + variant if variant else ""}"'
+
+    def stored_data_offset(self, member: str) -> Optional[int]:
+        # -> where the raw data of a stored (uncompressed and unencrypted) member starts within the cbz
+        zinfo: ZipInfo = self.zip.getinfo(member)
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x1:
+            return None
+        offset: Optional[int] = self._data_offsets.get(member)
+        if offset is None:
+            # the local header can have a different extra-field than the central directory -> read it
+            with open(self.zip.filename, "rb") as f:  # type: ignore
+                f.seek(zinfo.header_offset)
+                header: bytes = f.read(LOCAL_FILE_HEADER.size)
+            if len(header) != LOCAL_FILE_HEADER.size:
+                return None
+            signature, *_, filename_length, extra_length = LOCAL_FILE_HEADER.unpack(header)
+            if signature != b"PK\x03\x04":
+                return None
+            offset = zinfo.header_offset + LOCAL_FILE_HEADER.size + filename_length + extra_length
+            self._data_offsets[member] = offset
+        return offset
+
+
+cbz_cache: BoundedLru = BoundedLru(32, 8 * 1024 * 1024)
+
+def get_cbz_archive(file: str) -> CbzArchive:
+    file_stat = stat(file)
+    signature: Tuple[int, int] = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached: Optional[Tuple[Tuple[int, int], CbzArchive]] = cbz_cache.get(file)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with timed("cbz_open"):
+        archive: CbzArchive = CbzArchive(file, *signature)
+    cbz_cache.put(file, (signature, archive), archive.memory)
+    return archive
+
+def get_cbz_images(file: str) -> List[str]:
+    # the reader page only needs the sorted image-list -> no need to open the archive if the library-store knows it
+    if library_store is None:
+        return get_cbz_archive(file).images
+    file_stat = stat(file)
+    cached: Optional[Tuple[Tuple[int, int], CbzArchive]] = cbz_cache.get(file)
+    if cached is not None and cached[0] == (file_stat.st_mtime_ns, file_stat.st_size):
+        return cached[1].images
+    images: Optional[List[str]] = library_store.get_cbz_images(file, file_stat.st_mtime_ns, file_stat.st_size)
+    if images is None:
+        images = get_cbz_archive(file).images
+        library_store.queue_cbz(file, file_stat.st_mtime_ns, file_stat.st_size, images)
+    return images
+
+def is_image_member(filename: str) -> bool:
+    return get_index(filename.rsplit(".", 1), 1) in IMAGE_FILE_EXTENSIONS or filename.endswith(".ff.bz2")
+
+
+# size-capped cache directory (survives restarts), least recently used files get deleted first
+class DiskCache:
+    # mtime is used as "last used" after a restart, it only gets refreshed once it is older than this (seconds)
+    # -> hot entries do not cause a metadata write on every hit, the order on disk is only coarsely right
+    TOUCH_INTERVAL: float = 3600.0
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.current_bytes: int = 0
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # filename -> size (least recently used first)
+        self._lock: Lock = Lock()
+        makedirs(directory, exist_ok=True)
+        existing: List[Tuple[float, str, int]] = []
+        with scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".tmp"):
+                    unlink_quietly(entry.path)  # leftover from a crash
+                elif entry.is_file():
+                    entry_stat = entry.stat()
+                    existing.append((entry_stat.st_mtime, entry.name, entry_stat.st_size))
+        for _, name, size in sorted(existing):
+            self._files[name] = size
+            self.current_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        name: str = self._filename(key)
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            with open(path.join(self.directory, name), "rb") as f:
+                data: bytes = f.read()
+                stale: bool = time() - fstat(f.fileno()).st_mtime > self.TOUCH_INTERVAL
+            if stale:
+                utime(path.join(self.directory, name))
+        except OSError:
+            with self._lock:
+                self.current_bytes -= self._files.pop(name, 0)
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        name: str = self._filename(key)
+        target: str = path.join(self.directory, name)
+        tmp_file: str = f"{target}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            replace(tmp_file, target)
+        except OSError:
+            unlink_quietly(tmp_file)
+            return
+        with self._lock:
+            self.current_bytes += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.current_bytes > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self.current_bytes -= size
+            unlink_quietly(path.join(self.directory, name))
+
+    def _filename(self, key: str) -> str:
+        return hashlib.sha1(key.encode(encoding="utf-8", errors="surrogateescape")).hexdigest()
+
+
+# lets concurrent callers with the same key share the result of a single call
+class SingleFlight:
+    def __init__(self) -> None:
+        self._lock: Lock = Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+    def run(self, key: str, func: Callable[[], T]) -> T:
+        with self._lock:
+            future: Optional[Future] = self._in_flight.get(key)
+            owner: bool = future is None
+            if future is None:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+
+# memory-LRU in front of an (optional) disk-cache for generated data (converted pages, ..)
+class TwoTierCache:
+    def __init__(self, memory_bytes: int, disk: Optional[DiskCache] = None) -> None:
+        self.memory: BoundedLru = BoundedLru(1 << 30, memory_bytes)
+        self.disk: Optional[DiskCache] = disk
+        self.disk_hits: int = 0
+        self._single_flight: SingleFlight = SingleFlight()
+        self._background_lock: Lock = Lock()
+        self._background: Set[str] = set()  # keys queued for create_in_background
+
+    def get_or_create(self, key: str, create: Callable[[], bytes]) -> bytes:
+        data: Optional[bytes] = self.memory.get(key)
+        if data is None:
+            data = self._single_flight.run(key, lambda: self._load_or_create(key, create))
+        return data
+
+    def get(self, key: str) -> Optional[bytes]:
+        # -> None if it would have to be created
+        data: Optional[bytes] = self.memory.get(key)
+        if data is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.disk_hits += 1
+                self.memory.put(key, data, len(data))
+        return data
+
+    def create_in_background(self, key: str, create: Callable[[], bytes], executor: ThreadPoolExecutor) -> None:
+        # queues the creation without waiting for it (once per key, no matter how often it gets requested meanwhile)
+        with self._background_lock:
+            if key in self._background:
+                return
+            self._background.add(key)
+
+        def run() -> None:
+            try:
+                self.get_or_create(key, create)
+            except Exception as e:
+                sys.stderr.write(f"background creation of {key!r} failed: {e!r}\n")
+            finally:
+                with self._background_lock:
+                    self._background.discard(key)
+
+        executor.submit(run)
+
+    def _load_or_create(self, key: str, create: Callable[[], bytes]) -> bytes:
+        data: Optional[bytes] = self.disk.get(key) if self.disk is not None else None
+        if data is not None:
+            self.disk_hits += 1
+        else:
+            data = create()
+            if self.disk is not None:
+                self.disk.put(key, data)
+        self.memory.put(key, data, len(data))
+        return data
+
+
+# converted .ff.bz2 pages (key: cbz path, cbz mtime, member)
+page_cache: TwoTierCache = TwoTierCache(32 * 1024 * 1024)
+
+# thumbnails are created in the background within their own small pool (meanwhile requests get redirected to the full
+# image) so a listing full of new covers can neither occupy nor block the request-threads
+thumbnail_width: int = 0  # 0 -> listings reference the full images
+thumbnail_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cbzerv-thumbnail")
+thumbnail_cache: TwoTierCache = TwoTierCache(16 * 1024 * 1024)
+
+# opt-in downscaled/ re-encoded cbz pages (TRANSCODE), also within their own pool
+transcode_quality: int = 0  # 0 -> disabled
+transcode_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cbzerv-transcode")
+transcode_cache: TwoTierCache = TwoTierCache(64 * 1024 * 1024)
+
+# opt-in pdf reader (PDF_PAGES): single pages rendered on demand instead of embedding the whole pdf, within their own pool
+pdf_renderer: str = ""  # "" -> disabled, "pymupdf" or "pdftoppm"
+pdf_page_width: int = 1440
+pdf_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cbzerv-pdf")
+pdf_cache: TwoTierCache = TwoTierCache(64 * 1024 * 1024)
+pdf_page_counts: BoundedLru = BoundedLru(256, 1024 * 1024)  # key: pdf path; value: ((mtime_ns, size), page count)
+
+def thumbnail_query(filename: str) -> str:
+    # -> query-string for a picture within a listing
+    if not thumbnail_width:
+        return ""
+    extension: str = filename.rsplit(".", 1)[-1].lower()
+    return f"?thumb={thumbnail_width}" if extension in THUMBNAIL_SOURCE_EXTENSIONS or extension == "cbz" or extension == "pdf" and pdf_renderer else ""
+
+
+# optional on-disk (sqlite) copy of the tag-index, directory listings and cbz image-lists for a fast cold start
+# everything read from it gets validated using mtimes; writes are queued and done by the background rescan-thread
+class LibraryStore:
+    SCHEMA_VERSION: int = 1
+
+    def __init__(self, file: str, root: str) -> None:
+        self._lock: Lock = Lock()
+        self._pending_listings: Dict[str, Tuple[int, str]] = {}
+        self._pending_cbz: Dict[str, Tuple[int, int, str]] = {}
+        import sqlite3
+        self._connection: "sqlite3.Connection" = sqlite3.connect(file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")  # its a cache -> losing the last transactions on power-loss is fine
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            stored_meta: Dict[str, str] = dict(self._connection.execute("SELECT key, value FROM meta").fetchall())
+            if stored_meta != {"version": str(self.SCHEMA_VERSION), "root": root}:
+                # different format or library -> start over
+                for table in ("tag_dirs", "listings", "cbz"):
+                    self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+                self._connection.execute("DELETE FROM meta")
+                self._connection.executemany("INSERT INTO meta VALUES (?, ?)", (("version", str(self.SCHEMA_VERSION)), ("root", root)))
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tag_dirs (directory TEXT PRIMARY KEY, mtime_ns INTEGER, tagfile_mtime_ns INTEGER, tags TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS listings (directory TEXT PRIMARY KEY, mtime_ns INTEGER, entries TEXT)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cbz (file TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, pages INTEGER, images TEXT)")
+
+    def load_tag_index(self) -> List[TagIndexRow]:
+        with self._lock:
+            rows = self._connection.execute("SELECT directory, mtime_ns, tagfile_mtime_ns, tags FROM tag_dirs").fetchall()
+        return [(directory, mtime, tagfile_mtime, json.loads(tags) if tags is not None else None) for directory, mtime, tagfile_mtime, tags in rows]
+
+    def save_tag_index(self, state: List[TagIndexRow]) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM tag_dirs")
+            self._connection.executemany("INSERT INTO tag_dirs VALUES (?, ?, ?, ?)", (
+                (directory, mtime, tagfile_mtime, json.dumps(tags) if tags is not None else None)
+                for directory, mtime, tagfile_mtime, tags in state
+            ))
+
+    def get_listing(self, directory: str) -> Optional[Tuple[int, List[Tuple[str, Optional[int], Optional[str]]]]]:
+        with self._lock:
+            pending: Optional[Tuple[int, str]] = self._pending_listings.get(directory)
+            row = pending or self._connection.execute("SELECT mtime_ns, entries FROM listings WHERE directory = ?", (directory,)).fetchone()
+        if row is None:
+            return None
+        return row[0], [tuple(i) for i in json.loads(row[1])]  # type: ignore
+
+    def queue_listing(self, directory: str, mtime_ns: int, entries: List[Tuple[str, Optional[int], Optional[str]]]) -> None:
+        with self._lock:
+            self._pending_listings[directory] = (mtime_ns, json.dumps(entries))
+
+    def get_cbz_images(self, file: str, mtime_ns: int, size: int) -> Optional[List[str]]:
+        with self._lock:
+            pending: Optional[Tuple[int, int, str]] = self._pending_cbz.get(file)
+            row = pending or self._connection.execute("SELECT mtime_ns, size, images FROM cbz WHERE file = ?", (file,)).fetchone()
+        if row is None or (row[0], row[1]) != (mtime_ns, size):
+            return None
+        return json.loads(row[2])
+
+    def queue_cbz(self, file: str, mtime_ns: int, size: int, images: List[str]) -> None:
+        with self._lock:
+            self._pending_cbz[file] = (mtime_ns, size, json.dumps(images))
+
+    def flush(self) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (
+                (directory, mtime_ns, entries) for directory, (mtime_ns, entries) in self._pending_listings.items()
+            ))
+            self._connection.executemany("INSERT OR REPLACE INTO cbz VALUES (?, ?, ?, ?, ?)", (
+                (file, mtime_ns, size, len(json.loads(images)), images) for file, (mtime_ns, size, images) in self._pending_cbz.items()
+            ))
+            self._pending_listings.clear()
+            self._pending_cbz.clear()
+
+    def run_background_rescan(self, index: TagIndex, interval: float) -> None:
+        while True:
+            try:
+                index.refresh()
+                if index.dirty:
+                    self.save_tag_index(index.export_state())
+                self.flush()
+            except Exception as e:
+                sys.stderr.write(f"background rescan failed: {e!r}\n")
+            sleep(interval)
+
+
+library_store: Optional[LibraryStore] = None
+
+# compressed html pages (key: hash of the page, encoding) and static files (key: file, mtime, size, encoding)
+compressed_cache: BoundedLru = BoundedLru(1024, 16 * 1024 * 1024)
+
+search_page_size: int = 0  # default ?limit= for search results (0: everything on one page)
+
+
+def invalidate_paths(paths: Iterable[str]) -> None:
+    # drop everything cached about these changed (created, modified, removed) files and directories
+    index: TagIndex = get_tag_index()
+    directories: Set[str] = set()
+    for changed in paths:
+        parent: str = path.dirname(changed)
+        cbz_cache.pop(changed)
+        listing_cache.pop(changed)
+        listing_cache.pop(parent)
+        listing_cache.pop(path.dirname(parent))  # covers and `.ignore` files are part of the parents listing
+        directories.add(changed)
+        directories.add(parent)
+    for directory in directories:
+        index.invalidate(directory)
+
+
+# collects changed paths and hands them over in one batch once no new ones arrived for `delay` seconds
+# (a bulk-sync writing hundreds of cbz files should not trigger hundreds of invalidations)
+class Debouncer:
+    def __init__(self, delay: float, callback: Callable[[Set[str]], None]) -> None:
+        self.delay: float = delay
+        self.max_delay: float = delay * 10  # do not starve during a never-ending stream of changes
+        self.callback: Callable[[Set[str]], None] = callback
+        self._pending: Set[str] = set()
+        self._first_change: float = 0.0
+        self._last_change: float = 0.0
+        self._condition: Condition = Condition()
+        Thread(target=self._run, daemon=True, name="cbzerv-debouncer").start()
+
+    def add(self, changed_path: str) -> None:
+        with self._condition:
+            if not self._pending:
+                self._first_change = monotonic()
+            self._pending.add(changed_path)
+            self._last_change = monotonic()
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                now: float = monotonic()
+                remaining: float = min(self._last_change + self.delay, self._first_change + self.max_delay) - now
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                batch: Set[str] = self._pending
+                self._pending = set()
+            try:
+                self.callback(batch)
+            except Exception as e:
+                sys.stderr.write(f"cache invalidation failed: {e!r}\n")
+
+
+# linux inotify (via ctypes, no dependencies) on every directory below root
+class InotifyWatcher:
+    IN_MODIFY: int = 0x2
+    IN_ATTRIB: int = 0x4
+    IN_CLOSE_WRITE: int = 0x8
+    IN_MOVED_FROM: int = 0x40
+    IN_MOVED_TO: int = 0x80
+    IN_CREATE: int = 0x100
+    IN_DELETE: int = 0x200
+    IN_DELETE_SELF: int = 0x400
+    IN_MOVE_SELF: int = 0x800
+    IN_Q_OVERFLOW: int = 0x4000
+    IN_IGNORED: int = 0x8000
+    IN_ONLYDIR: int = 0x1000000
+    IN_ISDIR: int = 0x40000000
+    IN_CLOEXEC: int = 0o2000000
+    WATCH_MASK: int = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    )
+    EVENT_HEADER: struct.Struct = struct.Struct("iIII")  # watch descriptor, mask, cookie, length of name
+
+    def __init__(self, root: str, on_change: Callable[[str], None], on_overflow: Callable[[], None]) -> None:
+        import ctypes.util
+        libc_name: Optional[str] = ctypes.util.find_library("c")
+        if libc_name is None or not sys.platform.startswith("linux"):
+            raise OSError("inotify is not available")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd: int = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.on_change: Callable[[str], None] = on_change
+        self.on_overflow: Callable[[], None] = on_overflow
+        self._watches: Dict[int, str] = {}  # watch descriptor -> directory
+        self._watch_tree(root)
+        Thread(target=self._run, daemon=True, name="cbzerv-inotify").start()
+
+    def _watch_tree(self, top: str) -> None:
+        stack: List[str] = [top]
+        while stack:
+            directory: str = stack.pop()
+            wd: int = self._libc.inotify_add_watch(self._fd, directory.encode(errors="surrogateescape"), self.WATCH_MASK)
+            if wd < 0:
+                import ctypes
+                errno: int = ctypes.get_errno()
+                if errno == 28:  # ENOSPC: fs.inotify.max_user_watches reached
+                    raise OSError(errno, "too many directories for inotify (increase fs.inotify.max_user_watches)")
+                continue  # removed meanwhile, no permissions, ..
+            self._watches[wd] = directory
+            try:
+                with scandir(directory) as entries:
+                    stack.extend(i.path for i in entries if i.is_dir() and not i.is_symlink())
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        while True:
+            buffer: bytes = os.read(self._fd, 64 * 1024)
+            offset: int = 0
+            while offset + self.EVENT_HEADER.size <= len(buffer):
+                wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name: bytes = buffer[offset:offset + name_length].rstrip(b"\0")
+                offset += name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.on_overflow()
+                    continue
+                directory: Optional[str] = self._watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self._watches[wd]  # the directory is gone
+                    continue
+                changed: str = path.join(directory, name.decode(errors="surrogateescape")) if name else directory
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self._watch_tree(changed)
+                    except OSError as e:
+                        sys.stderr.write(f"unable to watch {changed}: {e}\n")
+                self.on_change(changed)
+
+
+# fallback if inotify is unavailable: let the tag-index check all directory mtimes every `interval` seconds
+class PollingWatcher:
+    def __init__(self, index: TagIndex, interval: float, on_change: Callable[[str], None]) -> None:
+        self.index: TagIndex = index
+        self.interval: float = interval
+        self.on_change: Callable[[str], None] = on_change
+        Thread(target=self._run, daemon=True, name="cbzerv-poll").start()
+
+    def _run(self) -> None:
+        while True:
+            sleep(self.interval)
+            for directory in self.index.refresh():
+                self.on_change(directory)
+
+
+def start_watcher(mode: str, root: str, index: TagIndex, debounce: float, poll_interval: float) -> None:
+    # mode: "inotify", "poll" or "auto"
+    debouncer: Debouncer = Debouncer(debounce, invalidate_paths)
+
+    def on_overflow() -> None:
+        # events got lost -> nothing can be trusted anymore
+        cbz_cache.clear()
+        listing_cache.clear()
+        index.rescan()
+
+    if mode in ("auto", "inotify"):
+        try:
+            InotifyWatcher(root, debouncer.add, on_overflow)
+            index.refresh_interval = float("inf")  # the watcher keeps it up to date
+            return
+        except OSError as e:
+            if mode == "inotify":
+                raise
+            sys.stderr.write(f"inotify unavailable ({e}), falling back to polling\n")
+    PollingWatcher(index, poll_interval, debouncer.add)
+    index.refresh_interval = float("inf")
+
+tag_index: Optional[TagIndex] = None
+_tag_index_lock: Lock = Lock()
+
+def get_tag_index() -> TagIndex:
+    global tag_index
+    with _tag_index_lock:
+        if tag_index is None:
+            tag_index = TagIndex(path.abspath(path.curdir))
+        return tag_index
 
-@lru_cache
 def read_tagfile(tagfile: str) -> List[str]:
     with open(tagfile, "r") as file_handle:
         lines = file_handle.readlines()
@@ -396,14 +2381,79 @@ def generate_html_pathstr(filepath: str) -> str:
         result.append(f'/<a href="{html.escape(filepath)}">{html.escape(p[1])}</a>')
         filepath = p[0]
 
-def find_all_tagfile_paths(basedir: Optional[str] = None) -> List[str]:
-    basedir = basedir or path.curdir
-    return [
-        path.join(subdir, filename)
-        for subdir, _, files in walk(basedir)
-        for filename in files
-        if filename == TAGFILE_NAME and not path.exists(path.join(subdir, ".ignore"))
-    ]
+def make_etag(mtime_ns: int, size: int) -> str:
+    return f'"{mtime_ns:x}-{size:x}"'
+
+def not_modified_since(http_date: Optional[str], mtime: float) -> bool:
+    if not http_date:
+        return False
+    try:
+        return int(mtime) <= email.utils.parsedate_to_datetime(http_date).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def unlink_quietly(file: str) -> None:
+    try:
+        unlink(file)
+    except OSError:
+        pass
+
+def read_file(file: str) -> bytes:
+    with open(file, "rb") as f:
+        return f.read()
+
+def get_query_value(parsedurl: ParseResult, key: str, default: str = "") -> str:
+    return get_index(parse_qs(parsedurl.query).get(key, []), 0) or default
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    # -> "br", "gzip" or None
+    accepted: Set[str] = set()
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.strip().partition(";")
+        quality: str = parameters.strip().removeprefix("q=").strip() if parameters.strip().startswith("q=") else "1"
+        try:
+            if float(quality) > 0:
+                accepted.add(name.strip().lower())
+        except ValueError:
+            pass
+    if BROTLI_AVAILABLE and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+def compress_memoised(data: bytes, encoding: str) -> bytes:
+    # hashing is a lot cheaper than compressing
+    cache_key: Tuple[bytes, str] = (hashlib.sha1(data).digest(), encoding)
+    compressed: Optional[bytes] = compressed_cache.get(cache_key)
+    if compressed is None:
+        with timed("compress"):
+            compressed = compress(data, encoding)
+        compressed_cache.put(cache_key, compressed, len(compressed))
+    return compressed
+
+def paginate(items: List[T], page: int, limit: int) -> Tuple[List[T], int]:
+    # -> (items on the page, amount of pages); limit 0: everything on one page
+    if limit <= 0:
+        return items, 1
+    return items[(page - 1) * limit:page * limit], max((len(items) + limit - 1) // limit, 1)
+
+def find_cover(directory: str) -> Optional[str]:
+    return next((i for i in FOLDER_IMAGE_NAMES if path.isfile(path.join(directory, i))), None)
+
+def parse_int(value: Optional[str], default: int) -> int:
+    return int(value) if value is not None and value.strip().isdigit() else default
+
+def parse_float(value: Optional[str], default: float) -> float:
+    try:
+        return float(value) if value is not None else default
+    except ValueError:
+        return default
 
 def get_mime(extension: str) -> Optional[str]:
     return FILE_EXT_TO_MIME.get(extension.lower(), None)
@@ -415,16 +2465,279 @@ def _sort_human_key(key: str) -> tuple:
         for i, e in enumerate(parts)
     )
 
-T = TypeVar('T')
 def get_index(l: List[T], idx: int) -> Optional[T]:
     return l[idx] if len(l) > idx else None
 
-def ff_bz2_to_png(ff_bz2: bytes) -> bytes:
-    return ff_to_png(bz2.decompress(ff_bz2))
+def make_thumbnail(source: bytes, width: int, image_format: str, quality: int = THUMBNAIL_QUALITY, max_height: int = 0) -> bytes:
+    # scales down to width (and max_height, default: 4 * width), never up
+    from PIL import Image  # type: ignore
+    max_height = max_height or width * 4
+    if source[:8] == b"farbfeld":
+        ff_width, ff_height, channels, bit_depth, pixels = decode_ff(source)
+        image = Image.frombuffer("RGBA" if channels == 4 else "RGB", (ff_width, ff_height), pixels[0::2] if bit_depth == 16 else pixels, "raw")
+    else:
+        image = Image.open(io.BytesIO(source))
+        image.draft("RGB", (width, max_height))  # lets jpeg decode at a lower resolution
+    with image:
+        image.thumbnail((width, max_height))
+        if image.mode not in ("RGB", "RGBA", "L") or (image_format == "jpeg" and image.mode == "RGBA"):
+            image = image.convert("RGBA" if image_format != "jpeg" and "A" in image.mode else "RGB")
+        output: io.BytesIO = io.BytesIO()
+        image.save(output, format=image_format.upper(), quality=quality)
+        return output.getvalue()
+
+def ff_bz2_to_image(ff_bz2: bytes, image_format: str = "png") -> bytes:
+    return ff_to_image(bz2.decompress(ff_bz2), image_format)
 
-def main(port: int) -> None:
-    server: HTTPServer = HTTPServer(("", port), RequestHandler)
-    server.serve_forever()
+def ff_to_image(ff: bytes, image_format: str = "png") -> bytes:
+    width, height, channels, bit_depth, pixels = decode_ff(ff)
+    if image_format == "png":
+        return encode_png(width, height, channels, bit_depth, pixels)
+    if bit_depth == 16:
+        pixels = pixels[0::2]  # big endian -> the high bytes
+    from PIL import Image  # type: ignore
+    with Image.frombuffer("RGBA" if channels == 4 else "RGB", (width, height), pixels, "raw") as image:
+        output: io.BytesIO = io.BytesIO()
+        image.save(output, format=image_format.upper(), lossless=True)
+        return output.getvalue()
+
+def decode_ff(ff: bytes) -> Tuple[int, int, int, int, bytes]:
+    # farbfeld: "farbfeld", width, height (u32 big endian), then RGBA pixels with u16 big endian samples
+    # -> (width, height, channels, bit depth, pixels)
+    # all slicing is done on the whole buffer at once (no per-pixel python code)
+    if ff[:8] != b"farbfeld" or len(ff) < 16:
+        raise ValueError("not a farbfeld image")
+    width, height = struct.unpack(">II", ff[8:16])
+    pixel_count: int = width * height
+    if len(ff) < 16 + pixel_count * 8:
+        raise ValueError("truncated farbfeld image")
+    samples: bytes = ff[16:16 + pixel_count * 8]
+    high_bytes: bytes = samples[0::2]
+    if high_bytes == samples[1::2]:
+        # every sample is x*257 (what 8bit -> 16bit conversion produces) -> 8bit is still lossless
+        pixels: bytearray = bytearray(high_bytes)
+        if pixels[3::4] == b"\xff" * pixel_count:
+            del pixels[3::4]  # fully opaque -> drop alpha
+            return width, height, 3, 8, bytes(pixels)
+        return width, height, 4, 8, bytes(pixels)
+    if samples[6::8] == samples[7::8] == b"\xff" * pixel_count:
+        pixels = bytearray(samples)
+        del pixels[6::8]
+        del pixels[6::7]
+        return width, height, 3, 16, bytes(pixels)
+    return width, height, 4, 16, samples
+
+def encode_png(width: int, height: int, channels: int, bit_depth: int, pixels: bytes) -> bytes:
+    # truecolor (+alpha) png without filters (the pixels have to be big endian for 16bit)
+    stride: int = width * channels * bit_depth // 8
+    pixel_view: memoryview = memoryview(pixels)
+    compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL)
+    idat: List[bytes] = []
+    for row_start in range(0, stride * height, stride):
+        idat.append(compressor.compress(b"\0"))  # filter type of the row: none
+        idat.append(compressor.compress(pixel_view[row_start:row_start + stride]))
+    idat.append(compressor.flush())
+    return b"".join((
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, 6 if channels == 4 else 2, 0, 0, 0)),
+        _png_chunk(b"IDAT", b"".join(idat)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+
+def run_cpu_bound(func: Callable[..., T], *args: Any) -> T:
+    with timed(func.__name__):
+        if cpu_pool is None:
+            return func(*args)
+        return cpu_pool.submit(func, *args).result()
+
+class PdfError(Exception):
+    pass
+
+# PyMuPDF is not thread-safe -> all of its calls happen under this lock (PROCESSES spreads the rendering over processes)
+_pymupdf_lock: Lock = Lock()
+
+def load_pymupdf() -> Any:
+    # optional: renders pdf pages (PDF_PAGES), imported on demand since it takes ~30 MiB (-> None if not installed)
+    try:
+        import pymupdf  # type: ignore
+    except ModuleNotFoundError:
+        try:
+            import fitz as pymupdf  # type: ignore  # PyMuPDF < 1.24.3
+        except ModuleNotFoundError:
+            return None
+    return pymupdf
+
+def choose_pdf_renderer(mode: str) -> str:
+    # mode: "off", "pymupdf", "pdftoppm" or "auto" (PyMuPDF if installed) -> "" if disabled/ unavailable
+    if mode in ("auto", "pymupdf") and load_pymupdf() is not None:
+        return "pymupdf"
+    if mode in ("auto", "pdftoppm") and shutil.which("pdftoppm") and shutil.which("pdfinfo"):
+        return "pdftoppm"
+    if mode != "off":
+        sys.stderr.write(f"PDF_PAGES={mode}: renderer unavailable, pdf files get embedded as a whole\n")
+    return ""
+
+def get_pdf_page_count(file: str) -> int:
+    file_stat = stat(file)
+    signature: Tuple[int, int] = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached: Optional[Tuple[Tuple[int, int], int]] = pdf_page_counts.get(file)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with timed("pdf_page_count"):
+        page_count: int = count_pdf_pages(file, pdf_renderer)
+    pdf_page_counts.put(file, (signature, page_count), 200 + 2 * len(file))
+    return page_count
+
+def count_pdf_pages(file: str, renderer: str) -> int:
+    if renderer == "pymupdf":
+        try:
+            with _pymupdf_lock, load_pymupdf().open(file) as document:
+                return document.page_count
+        except RuntimeError as e:  # (FileDataError and co.)
+            raise PdfError(str(e)) from e
+    import subprocess
+    try:
+        result = subprocess.run(["pdfinfo", file], capture_output=True, timeout=PDF_RENDER_TIMEOUT)
+    except subprocess.TimeoutExpired as e:
+        raise PdfError(str(e)) from e
+    match: Optional[re.Match] = re.search(rb"^Pages:\s+(\d+)", result.stdout, re.MULTILINE)
+    if result.returncode != 0 or match is None:
+        raise PdfError(result.stderr.decode(errors="replace").strip() or "pdfinfo failed")
+    return int(match.group(1))
+
+def render_pdf_page(file: str, page: int, width: int, renderer: str) -> bytes:
+    # -> png of the page (1-based) scaled to width
+    if renderer == "pymupdf":
+        pymupdf: Any = load_pymupdf()
+        try:
+            with _pymupdf_lock, pymupdf.open(file) as document:
+                pdf_page: Any = document[page - 1]
+                zoom: float = width / max(pdf_page.rect.width, 1)
+                return pdf_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False).tobytes("png")
+        except RuntimeError as e:
+            raise PdfError(str(e)) from e
+    # without an output-root pdftoppm writes the (single) page to stdout
+    import subprocess
+    try:
+        result = subprocess.run(
+            ["pdftoppm", "-f", str(page), "-l", str(page), "-singlefile", "-png", "-scale-to-x", str(width), "-scale-to-y", "-1", file],
+            capture_output=True, timeout=PDF_RENDER_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired as e:
+        raise PdfError(str(e)) from e
+    if result.returncode != 0 or not result.stdout:
+        raise PdfError(result.stderr.decode(errors="replace").strip() or "pdftoppm failed")
+    return result.stdout
+
+def main(
+    port: int,
+    threads: int = 8,
+    processes: int = 0,
+    index_refresh_interval: float = 5.0,
+    cbz_cache_size: int = 32,
+    cbz_cache_memory: int = 8 * 1024 * 1024,
+    page_cache_memory: int = 32 * 1024 * 1024,
+    cache_dir: Optional[str] = None,
+    cache_dir_size: int = 512 * 1024 * 1024,
+    listing_cache_size: int = 256,
+    thumbnails: int = 300,
+    thumbnail_threads: int = 2,
+    index_file: Optional[str] = None,
+    index_rescan_interval: float = 60.0,
+    watch: str = "off",
+    watch_debounce: float = 2.0,
+    search_results_per_page: int = 0,
+    enable_metrics: bool = False,
+    profile: float = 0.0,
+    transcode: bool = False,
+    transcode_quality_setting: int = 80,
+    transcode_threads: int = 2,
+    transcode_cache_memory: int = 64 * 1024 * 1024,
+    pdf_pages: str = "off",
+    pdf_page_width_setting: int = 1440,
+    pdf_threads: int = 2,
+    pdf_cache_memory: int = 64 * 1024 * 1024,
+    server_core: str = "threads",
+) -> None:
+    global cpu_pool, tag_index, cbz_cache, page_cache, listing_cache, thumbnail_width, thumbnail_pool, thumbnail_cache, library_store
+    global search_page_size, metrics, profile_rate, transcode_quality, transcode_pool, transcode_cache
+    global pdf_renderer, pdf_page_width, pdf_pool, pdf_cache
+    search_page_size = search_results_per_page
+    metrics = Metrics() if enable_metrics else None
+    profile_rate = profile
+    if processes > 0:
+        # create it before any other threads exist (forking a multi-threaded process is asking for trouble)
+        from concurrent.futures import ProcessPoolExecutor  # (pulls in multiprocessing)
+        cpu_pool = ProcessPoolExecutor(max_workers=processes)
+        cpu_pool.submit(abs, 0).result()  # the workers only get started by the first job
+    thumbnail_width = thumbnails if PIL_AVAILABLE else 0
+    thumbnail_pool = ThreadPoolExecutor(max_workers=max(thumbnail_threads, 1), thread_name_prefix="cbzerv-thumbnail")
+    thumbnail_cache = TwoTierCache(16 * 1024 * 1024, DiskCache(path.join(cache_dir, "thumbnails"), cache_dir_size) if cache_dir else None)
+    transcode_quality = transcode_quality_setting if transcode and PIL_AVAILABLE else 0
+    transcode_pool = ThreadPoolExecutor(max_workers=max(transcode_threads, 1), thread_name_prefix="cbzerv-transcode")
+    transcode_cache = TwoTierCache(transcode_cache_memory, DiskCache(path.join(cache_dir, "transcoded"), cache_dir_size) if cache_dir else None)
+    pdf_renderer = choose_pdf_renderer(pdf_pages)
+    pdf_page_width = pdf_page_width_setting
+    pdf_pool = ThreadPoolExecutor(max_workers=max(pdf_threads, 1), thread_name_prefix="cbzerv-pdf")
+    pdf_cache = TwoTierCache(pdf_cache_memory, DiskCache(path.join(cache_dir, "pdf"), cache_dir_size) if cache_dir else None)
+    cbz_cache = BoundedLru(cbz_cache_size, cbz_cache_memory)
+    listing_cache = BoundedLru(listing_cache_size, 16 * 1024 * 1024)
+    page_cache = TwoTierCache(page_cache_memory, DiskCache(path.join(cache_dir, "pages"), cache_dir_size) if cache_dir else None)
+    if index_file:
+        library_store = LibraryStore(index_file, path.abspath(path.curdir))
+        tag_index = TagIndex(path.abspath(path.curdir), index_refresh_interval, library_store.load_tag_index())
+        Thread(target=library_store.run_background_rescan, args=(tag_index, index_rescan_interval), daemon=True).start()
+    else:
+        tag_index = TagIndex(path.abspath(path.curdir), index_refresh_interval)
+    if watch != "off":
+        start_watcher(watch, path.abspath(path.curdir), tag_index, watch_debounce, max(index_refresh_interval, 1.0))
+    server: Any = (
+        AsyncHTTPServer(("", port), max(threads, 1))
+        if server_core == "asyncio" else
+        PooledHTTPServer(("", port), RequestHandler, threads)
+        if threads > 1 else
+        HTTPServer(("", port), RequestHandler)
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if cpu_pool is not None:
+            cpu_pool.shutdown(wait=False, cancel_futures=True)
+        if library_store is not None:
+            library_store.flush()
 
 if __name__ == "__main__":
-    main(int(environ.get("PORT", "8080")))
+    main(
+        port=int(environ.get("PORT", "8080")),
+        threads=int(environ.get("THREADS", "8")),
+        processes=int(environ.get("PROCESSES", "0")),
+        index_refresh_interval=float(environ.get("INDEX_REFRESH_INTERVAL", "5")),
+        cbz_cache_size=int(environ.get("CBZ_CACHE_SIZE", "32")),
+        cbz_cache_memory=int(environ.get("CBZ_CACHE_MEMORY", str(8 * 1024 * 1024))),
+        page_cache_memory=int(environ.get("PAGE_CACHE_MEMORY", str(32 * 1024 * 1024))),
+        cache_dir=environ.get("CACHE_DIR") or None,
+        cache_dir_size=int(environ.get("CACHE_DIR_SIZE", str(512 * 1024 * 1024))),
+        listing_cache_size=int(environ.get("LISTING_CACHE_SIZE", "256")),
+        thumbnails=int(environ.get("THUMBNAILS", "300")),
+        thumbnail_threads=int(environ.get("THUMBNAIL_THREADS", "2")),
+        index_file=environ.get("INDEX_FILE") or None,
+        index_rescan_interval=float(environ.get("INDEX_RESCAN_INTERVAL", "60")),
+        watch=environ.get("WATCH", "off"),
+        watch_debounce=float(environ.get("WATCH_DEBOUNCE", "2")),
+        search_results_per_page=int(environ.get("SEARCH_RESULTS_PER_PAGE", "0")),
+        enable_metrics=environ.get("METRICS", "") not in ("", "0"),
+        profile=float(environ.get("PROFILE", "0")),
+        transcode=environ.get("TRANSCODE", "") not in ("", "0"),
+        transcode_quality_setting=int(environ.get("TRANSCODE_QUALITY", "80")),
+        transcode_threads=int(environ.get("TRANSCODE_THREADS", "2")),
+        transcode_cache_memory=int(environ.get("TRANSCODE_CACHE_MEMORY", str(64 * 1024 * 1024))),
+        pdf_pages=environ.get("PDF_PAGES", "off"),
+        pdf_page_width_setting=int(environ.get("PDF_PAGE_WIDTH", "1440")),
+        pdf_threads=int(environ.get("PDF_THREADS", "2")),
+        pdf_cache_memory=int(environ.get("PDF_CACHE_MEMORY", str(64 * 1024 * 1024))),
+        server_core=environ.get("SERVER", "threads"),
+    )
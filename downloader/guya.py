@@ -5,10 +5,17 @@
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from zipfile import ZipFile
-from typing import Optional, List
-from time import sleep
-from os import path, makedirs, unlink
+from typing import Optional, List, Dict, Tuple, Any
+from time import monotonic, sleep
+from os import path, makedirs, unlink, replace, chmod, stat, umask
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urlparse
+import hashlib
+import tempfile
 
 
 IMAGE_URL_SCHEMES: List[str] = [
@@ -23,29 +30,149 @@ IMAGE_FILE_EXTENSIONS: List[str] = [
     "svg",
     "webp",
 ]
+# chapters are written here first and moved into place once complete (has to be on the same filesystem)
+PARTIAL_DIR_NAME: str = ".guya-partial"
+# per series: what was downloaded (chapter hashes, groups, images) and the http cache-validators of its metadata
+SYNC_MANIFEST_NAME: str = ".guya_sync.json"
+SYNC_MANIFEST_VERSION: int = 1
+REQUEST_TIMEOUT: float = 60.0
+# for files written via mkstemp (0600); the umask can only be read by setting it -> once, before there are other threads
+UMASK: int = umask(0o022)
+umask(UMASK)
+
+
+# allows `rate` requests per second on average and bursts of up to `burst` requests
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate: float = rate
+        self.burst: int = max(burst, 1)
+        self._tokens: float = float(self.burst)
+        self._last: float = monotonic()
+        self._lock: Lock = Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now: float = monotonic()
+                self._tokens = min(self._tokens + (now - self._last) * self.rate, self.burst)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait: float = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+
+# shared connection-pool, per-host concurrency limit and rate limit for all requests
+class Downloader:
+    def __init__(self, website_domain: str, max_connections: int, requests_per_second: float, parallel_chapters: int) -> None:
+        self.website_domain: str = website_domain
+        self.max_connections: int = max(max_connections, 1)
+        self.session: requests.Session = requests.Session()
+        adapter: HTTPAdapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.max_connections,
+            max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"]),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limit: TokenBucket = TokenBucket(requests_per_second, self.max_connections)
+        self.image_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="guya-image")
+        self.chapter_pool: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max(parallel_chapters, 1), thread_name_prefix="guya-chapter")
+        self._host_limits: Dict[str, BoundedSemaphore] = {}
+        self._host_limits_lock: Lock = Lock()
+        self._image_url_schemes: Dict[str, int] = {}  # series-slug -> index of the image-url-scheme which worked last
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        host: str = urlparse(url).netloc
+        with self._host_limits_lock:
+            host_limit: BoundedSemaphore = self._host_limits.setdefault(host, BoundedSemaphore(self.max_connections))
+        with host_limit:
+            self.rate_limit.acquire()
+            return self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+
+    def get_image(self, series_slug: str, chapter_no: str, folder: Optional[str], group_id: str, image: str) -> bytes:
+        # the scheme which worked for the last image of this series gets tried first
+        preferred: int = self._image_url_schemes.get(series_slug, 0)
+        for scheme_index in [preferred, *(i for i in range(len(IMAGE_URL_SCHEMES)) if i != preferred)]:
+            image_url: str = IMAGE_URL_SCHEMES[scheme_index].format(
+                chapter_no=chapter_no,
+                folder=folder,
+                group_id=group_id,
+                image=image,
+                series_slug=series_slug,
+                website_domain=self.website_domain,
+            )
+            response: requests.Response = self.get(image_url)
+            if response.status_code == 200:
+                self._image_url_schemes[series_slug] = scheme_index
+                # no need to read chunked. if a single image is to big for ram its not a usable manga anyway
+                return response.content
+        assert False, f"Failed to download image {image} for {series_slug}/{chapter_no} (none of the attempted image-url-schemes worked)"
+
+    def close(self) -> None:
+        self.chapter_pool.shutdown(cancel_futures=True)
+        self.image_pool.shutdown(cancel_futures=True)
+        self.session.close()
 
 
 def main(
     base_download_dir: str = "./cbzerv",
     website_domain: str = "https://localhost:8000",
     series_slugs: Optional[List[str]] = None,
-    sleep_time_between_images: float = 0.1,
+    max_connections: int = 4,
+    requests_per_second: float = 10.0,
+    parallel_chapters: int = 2,
 ):
-    if series_slugs is None:
-        print("No series specified. Downloading all series.")
-        series_slugs = get_all_series_slugs(website_domain)
-        print(f"Found {len(series_slugs)} series.")
+    downloader: Downloader = Downloader(website_domain, max_connections, requests_per_second, parallel_chapters)
+    try:
+        last_updated: Dict[str, Any] = {}
+        if series_slugs is None:
+            print("No series specified. Downloading all series.")
+            last_updated = get_all_series(downloader)
+            series_slugs = list(last_updated.keys())
+            print(f"Found {len(series_slugs)} series.")
 
-    for series_slug in series_slugs:
-        download_series(base_download_dir, website_domain, series_slug, sleep_time_between_images)
+        for series_slug in series_slugs:
+            download_series(base_download_dir, downloader, series_slug, last_updated.get(series_slug))
+    finally:
+        downloader.close()
 
 
-def download_series(base_download_dir: str, website_domain: str, series_slug: str, sleep_time_between_images: float) -> None:
+def download_series(base_download_dir: str, downloader: Downloader, series_slug: str, last_updated: Any = None) -> None:
+    # last_updated: from the series-list, if it did not change since the last sync the series is skipped without any request
+    website_domain: str = downloader.website_domain
+    series_dir: str = path.join(base_download_dir, series_slug)
+    manifest: Dict[str, Any] = load_manifest(series_dir)
+    if last_updated is not None and manifest.get("last_updated") == last_updated and all_chapters_exist(series_dir, manifest):
+        print(f"Skipped {series_slug} (unchanged)")
+        return
     print(f"Downloading {series_slug}..")
-    response = requests.get(f"{website_domain}/api/series/{series_slug}")
+    complete: bool = all_chapters_exist(series_dir, manifest)
+    conditional_headers: Dict[str, str] = {}
+    if complete:
+        if manifest.get("etag"):
+            conditional_headers["If-None-Match"] = manifest["etag"]
+        if manifest.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = manifest["last_modified"]
+    response = downloader.get(f"{website_domain}/api/series/{series_slug}", conditional_headers)
+    if response.status_code == 304:
+        manifest["last_updated"] = last_updated
+        save_manifest(base_download_dir, series_dir, manifest)
+        print(f"Skipped {series_slug} (not modified)")
+        return
     response.raise_for_status()
+    series_hash: str = hashlib.sha1(response.content).hexdigest()
+    series_validators: Dict[str, Optional[str]] = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    if complete and manifest.get("series_hash") == series_hash:
+        # the server does not support conditional requests, but nothing changed either
+        manifest.update(series_validators, last_updated=last_updated)
+        save_manifest(base_download_dir, series_dir, manifest)
+        print(f"Skipped {series_slug} (unchanged)")
+        return
     data = response.json()
-    series_dir: str = path.join(base_download_dir, series_slug)
     if not path.exists(series_dir):
         makedirs(series_dir, exist_ok=True)
     assert path.isdir(path.realpath(series_dir)), f"Cannot download {series_slug} since the target directory ({series_dir}) exists and is not a directory"
@@ -66,58 +193,151 @@ def download_series(base_download_dir: str, website_domain: str, series_slug: st
     ):
         cover_url: str = f"{website_domain}/{data['cover']}" if data['cover'][0] == '/' else data['cover']
         try:
-            response = requests.get(cover_url)
+            response = downloader.get(cover_url)
             response.raise_for_status()
-            with open(image_path, "wb") as fp:
-                fp.write(response.content)
+            write_atomically(base_download_dir, image_path, lambda fp: fp.write(response.content))
         except Exception:
             print(f"Failed to download series cover for {series_slug} from {data['cover']}")
 
+    synced_chapters: Dict[str, Dict[str, Any]] = manifest.setdefault("chapters", {})
+    chapters: List[Tuple[str, Dict[str, Any], Future]] = []
     for chapter_no, chapter_data in data["chapters"].items():
-        folder: Optional[str] = chapter_data.get("folder", None)
         target_cbz_file: str = path.join(series_dir, f"{chapter_no}.cbz")
+        chapter_hash: str = hashlib.sha1(json.dumps(chapter_data, sort_keys=True).encode()).hexdigest()
+        synced: Optional[Dict[str, Any]] = synced_chapters.get(chapter_no)
         if path.exists(target_cbz_file):
-            print(f"Skipped {series_slug}/{chapter_no} (file already existed)")
+            if synced is None:
+                # downloaded before there was a manifest -> assume it is up to date
+                synced_chapters[chapter_no] = {"hash": chapter_hash, **chapter_source(chapter_data)}
+                print(f"Skipped {series_slug}/{chapter_no} (file already existed)")
+                continue
+            if synced["hash"] == chapter_hash:
+                continue
+            print(f"Updating {series_slug}/{chapter_no} (changed)")
+        source: Dict[str, Any] = chapter_source(chapter_data)
+        # pages with the same name from the same group and folder are taken from the existing cbz
+        reusable: List[str] = []
+        if synced is not None and path.exists(target_cbz_file) and (synced["group_id"], synced["folder"]) == (source["group_id"], source["folder"]):
+            synced_images: set = set(synced["images"])
+            reusable = [i for i in source["images"] if i in synced_images]
+        chapters.append((chapter_no, {"hash": chapter_hash, **source}, downloader.chapter_pool.submit(
+            download_chapter, base_download_dir, downloader, series_slug, chapter_no, source, target_cbz_file, reusable,
+        )))
+    # let the other chapters finish, then raise the first error
+    errors: List[Exception] = []
+    for chapter_no, synced_chapter, future in chapters:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Failed to download {series_slug}/{chapter_no}: {e!r}")
+            errors.append(e)
             continue
-        print(f"Downloading {series_slug}/{chapter_no}..")
-        group_id, images = next((group_id, images) for group_id, images in chapter_data["groups"].items() if len(images) > 0)
+        synced_chapters[chapter_no] = synced_chapter
+        save_manifest(base_download_dir, series_dir, manifest)
+    if errors:
+        raise errors[0]
+    # only now the series counts as synced (a failed chapter gets retried by the next run)
+    manifest.update(series_validators, series_hash=series_hash, last_updated=last_updated)
+    save_manifest(base_download_dir, series_dir, manifest)
+
+
+def download_chapter(
+    base_download_dir: str,
+    downloader: Downloader,
+    series_slug: str,
+    chapter_no: str,
+    source: Dict[str, Any],
+    target_cbz_file: str,
+    reusable: List[str],
+) -> None:
+    # reusable: images which can be copied from the existing target_cbz_file
+    print(f"Downloading {series_slug}/{chapter_no}..")
+    images: List[str] = source["images"]
+    old_cbz: Optional[ZipFile] = ZipFile(target_cbz_file, "r") if reusable else None
+    reuse: set = set(reusable)
+    # the images get downloaded in parallel, but written in order
+    pending: List[Future] = [
+        downloader.image_pool.submit(downloader.get_image, series_slug, chapter_no, source["folder"], source["group_id"], image)
+        for image in images if image not in reuse
+    ]
+
+    def write(fp) -> None:
+        downloads = iter(pending)
+        with ZipFile(fp, "w", compresslevel=9) as cbz:
+            for image in images:
+                member: str = image.split('?')[0]
+                if image in reuse:
+                    cbz.writestr(member, old_cbz.read(member))  # type: ignore
+                else:
+                    cbz.writestr(member, next(downloads).result())
+
+    try:
+        write_atomically(base_download_dir, target_cbz_file, write)
+    finally:
+        for i in pending:
+            i.cancel()
+        if old_cbz is not None:
+            old_cbz.close()
+    print(f"Downloaded {series_slug}/{chapter_no}" + (f" ({len(reuse)} unchanged pages kept)" if reuse else ""))
+
+
+def chapter_source(chapter_data: Dict[str, Any]) -> Dict[str, Any]:
+    # which group (and images) gets downloaded for a chapter: the first one with images
+    group_id, images = next((group_id, images) for group_id, images in chapter_data["groups"].items() if len(images) > 0)
+    return {"group_id": group_id, "folder": chapter_data.get("folder", None), "images": images}
+
+
+def load_manifest(series_dir: str) -> Dict[str, Any]:
+    try:
+        with open(path.join(series_dir, SYNC_MANIFEST_NAME), "r") as fp:
+            manifest: Dict[str, Any] = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {"version": SYNC_MANIFEST_VERSION, "chapters": {}}
+    if manifest.get("version") != SYNC_MANIFEST_VERSION:
+        return {"version": SYNC_MANIFEST_VERSION, "chapters": {}}
+    return manifest
+
+
+def save_manifest(base_download_dir: str, series_dir: str, manifest: Dict[str, Any]) -> None:
+    write_atomically(base_download_dir, path.join(series_dir, SYNC_MANIFEST_NAME), lambda fp: fp.write(json.dumps(manifest, indent=1).encode()))
+
+
+def all_chapters_exist(series_dir: str, manifest: Dict[str, Any]) -> bool:
+    # (somebody could have deleted a chapter to get it re-downloaded)
+    return bool(manifest.get("chapters")) and all(path.exists(path.join(series_dir, f"{i}.cbz")) for i in manifest["chapters"])
+
+
+def write_atomically(base_download_dir: str, target_file: str, write) -> None:
+    # the file only appears (complete) once write returned; the partial-dir is ignored by cbzerv (.ignore)
+    partial_dir: str = path.join(base_download_dir, PARTIAL_DIR_NAME)
+    makedirs(partial_dir, exist_ok=True)
+    if not path.exists(path.join(partial_dir, ".ignore")):
+        open(path.join(partial_dir, ".ignore"), "w").close()
+    fd, temp_file = tempfile.mkstemp(dir=partial_dir, suffix="." + target_file.rsplit(".", 1)[-1])
+    try:
+        with open(fd, "wb") as fp:
+            write(fp)
+        # mkstemp creates it as 0600 -> the mode of the file it replaces or the usual one
+        chmod(temp_file, stat(target_file).st_mode & 0o7777 if path.exists(target_file) else 0o666 & ~UMASK)
+        replace(temp_file, target_file)
+    except BaseException:
         try:
-            with ZipFile(target_cbz_file, "w", compresslevel=9) as cbz:
-                for image in images:
-                    for image_url_scheme in IMAGE_URL_SCHEMES:
-                        # TODO: cache which scheme works and try it first
-                        image_url: str = image_url_scheme.format(
-                            chapter_no=chapter_no,
-                            folder=folder,
-                            group_id=group_id,
-                            image=image,
-                            series_slug=series_slug,
-                            website_domain=website_domain,
-                        )
-                        response = requests.get(image_url)
-                        if response.status_code == 200:
-                            break
-                    else:
-                        assert False, f"Failed to download image {image} for {series_slug}/{chapter_no} (none of the attempted image-url-schemes worked)"
-                    # no need to read chunked. if a single image is to big for ram its not a usable manga anyway
-                    cbz.writestr(image.split('?')[0], response.content)
-                    sleep(sleep_time_between_images)
-        except Exception as orig_exc:
-            try:
-                unlink(target_cbz_file)  # if it failed the file is incomplete/broken
-            except FileNotFoundError as e:
-                pass
-            raise orig_exc
-
-
-def get_all_series_slugs(website_domain: str) -> List[str]:
-    response = requests.get(f"{website_domain}/api/get_all_series/")
+            unlink(temp_file)  # if it failed the file is incomplete/broken
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def get_all_series(downloader: Downloader) -> Dict[str, Any]:
+    # -> series-slug -> when it was last updated (None if the instance does not tell)
+    response = downloader.get(f"{downloader.website_domain}/api/get_all_series/")
     response.raise_for_status()
-    return [data["slug"] for name, data in response.json().items()]
+    return {data["slug"]: data.get("last_updated") for name, data in response.json().items()}
 
 
 if __name__ == "__main__":
     import argparse
+    import sys
     parser = argparse.ArgumentParser(
         prog="guya-downloader.py",
         description="Download mangas from guya instances",
@@ -126,19 +346,23 @@ if __name__ == "__main__":
     parser.add_argument("base_download_directory", help="Where to store the downloads? (the series-slug will be auto-appended). Example: ./cbzerv/manga")
     parser.add_argument("series_slugs", nargs="*", help="The slug(-s) of the series you want to download. It is the manga-name similar part of the reader-url. Example: steamboat-willie")
     parser.add_argument("--all-series", action="store_true", help="Download all series available on the website")
-    parser.add_argument("--sleep-time-between-images", type=float, help="Sleep between image downloads for x seconds to prevent DOSing the website (or getting banned for it)", default=0.1)
+    parser.add_argument("--max-connections", type=int, help="How many requests can be in flight at the same time (per host)", default=4)
+    parser.add_argument("--requests-per-second", type=float, help="Limit the request rate to prevent DOSing the website (or getting banned for it) (0: unlimited)", default=10.0)
+    parser.add_argument("--parallel-chapters", type=int, help="How many chapters can be downloaded at the same time", default=2)
+    parser.add_argument("--sleep-time-between-images", type=float, help="Deprecated: use --requests-per-second (= 1 / x) instead")
     args = parser.parse_args()
-    if args.all_series:
-        main(
-            base_download_dir=args.base_download_directory,
-            website_domain=args.website_domain,
-            series_slugs=None,
-            sleep_time_between_images=args.sleep_time_between_images,
-        )
-    else:
-        main(
-            base_download_dir=args.base_download_directory,
-            website_domain=args.website_domain,
-            series_slugs=args.series_slugs,
-            sleep_time_between_images=args.sleep_time_between_images,
+    if args.sleep_time_between_images is not None:
+        # sleeping x seconds after each image roughly was a rate of 1 / x requests per second
+        args.requests_per_second = 1 / args.sleep_time_between_images if args.sleep_time_between_images > 0 else 0
+        print(
+            f"Warning: --sleep-time-between-images is deprecated, use --requests-per-second {args.requests_per_second:g} instead",
+            file=sys.stderr,
         )
+    main(
+        base_download_dir=args.base_download_directory,
+        website_domain=args.website_domain,
+        series_slugs=None if args.all_series else args.series_slugs,
+        max_connections=args.max_connections,
+        requests_per_second=args.requests_per_second,
+        parallel_chapters=args.parallel_chapters,
+    )
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Compare the built-in farbfeld decoder of cbzerv against ImageMagick (subprocess and Wand)
+# usage: python3 tools/bench_farbfeld.py --width 1400 --height 2000 --rounds 5
+
+import random
+import struct
+import subprocess
+import sys
+from os import path
+from shutil import which
+from time import perf_counter
+from typing import Callable, Dict, List
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import cbzerv  # noqa: E402
+
+
+def generate_ff(width: int, height: int, eight_bit: bool) -> bytes:
+    # a few gradients and noise (comic pages are mostly flat areas, so this is somewhat pessimistic)
+    rng: random.Random = random.Random(width * height)
+    row_pixels: List[bytes] = []
+    for y in range(height):
+        base: int = (y * 255) // max(height - 1, 1)
+        row: bytes = bytes((base + rng.randrange(16)) & 0xFF for _ in range(width * 3))
+        row_pixels.append(row)
+    pixels: bytearray = bytearray()
+    for row in row_pixels:
+        rgba: bytearray = bytearray(width * 4)
+        rgba[0::4] = row[0::3]
+        rgba[1::4] = row[1::3]
+        rgba[2::4] = row[2::3]
+        rgba[3::4] = b"\xff" * width
+        samples: bytearray = bytearray(len(rgba) * 2)
+        samples[0::2] = rgba
+        samples[1::2] = rgba if eight_bit else bytes(rng.randrange(256) for _ in range(len(rgba)))
+        pixels += samples
+    return b"farbfeld" + struct.pack(">II", width, height) + bytes(pixels)
+
+
+def converters() -> Dict[str, Callable[[bytes], bytes]]:
+    result: Dict[str, Callable[[bytes], bytes]] = {"native": cbzerv.ff_to_image}
+    if which("magick"):
+        result["magick (subprocess)"] = lambda x: subprocess.Popen(
+            ["magick", "FF:-", "PNG:-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        ).communicate(x)[0]
+    try:
+        from wand.image import Image  # type: ignore
+        result["wand"] = lambda x: Image(blob=x, format="FF").make_blob(format="PNG")
+    except ModuleNotFoundError:
+        pass
+    return result
+
+
+def main(width: int, height: int, rounds: int) -> None:
+    for eight_bit in (True, False):
+        ff: bytes = generate_ff(width, height, eight_bit)
+        print(f"{width}x{height} {'8bit' if eight_bit else '16bit'} ({len(ff)} bytes farbfeld):")
+        for name, converter in converters().items():
+            timings: List[float] = []
+            output_size: int = 0
+            for _ in range(rounds):
+                start: float = perf_counter()
+                output_size = len(converter(ff))
+                timings.append(perf_counter() - start)
+            timings.sort()
+            print(f"  {name:<20} min {timings[0] * 1000:8.1f}ms  median {timings[len(timings) // 2] * 1000:8.1f}ms  png {output_size} bytes")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="bench_farbfeld.py",
+        description="Benchmark farbfeld -> png conversion",
+    )
+    parser.add_argument("--width", type=int, default=1400)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    main(args.width, args.height, args.rounds)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Reproducible benchmark of cbzerv: generates a synthetic library and measures the main endpoints,
+# in-process (RequestHandler on in-memory streams) and over a local socket (PooledHTTPServer, AsyncHTTPServer with keep-alive)
+# usage: python3 tools/benchmark.py --series 200 --requests 300 --concurrency 4
+
+import bz2
+import http.client
+import io
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from threading import Lock, Thread, local
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import cbzerv  # noqa: E402
+
+# a page with a header, some text-ish noise and flat panels (compresses roughly like a real page)
+def generate_page(rng: random.Random, width: int, height: int) -> bytes:
+    rows: List[bytes] = []
+    flat: bytes = bytes((rng.randrange(256), rng.randrange(256), rng.randrange(256))) * width
+    for y in range(height):
+        if y % 97 < 12:
+            rows.append(bytes(rng.getrandbits(8) & 0xF0 for _ in range(width * 3)))
+        else:
+            rows.append(flat)
+    return cbzerv.encode_png(width, height, 3, 8, b"".join(rows))
+
+def generate_ff_bz2(rng: random.Random, width: int, height: int) -> bytes:
+    pixel: bytes = bytes((rng.randrange(256), 0, rng.randrange(256), 0, rng.randrange(256), 0, 255, 255))
+    return bz2.compress(b"farbfeld" + struct.pack(">II", width, height) + pixel * (width * height))
+
+def generate_pdf(title: str) -> bytes:
+    # the smallest useful pdf: one page with one line of text
+    stream: bytes = f"BT /F1 24 Tf 72 720 Td ({title}) Tj ET".encode()
+    objects: List[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    result: bytearray = bytearray(b"%PDF-1.4\n")
+    offsets: List[int] = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(result))
+        result += b"%d 0 obj\n%s\nendobj\n" % (i, obj)
+    xref: int = len(result)
+    result += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    result += b"".join(b"%010d 00000 n \n" % i for i in offsets)
+    result += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(result)
+
+def generate_library(root: str, series: int, chapters: int, pages: int, tags: int, page_width: int, page_height: int) -> None:
+    rng: random.Random = random.Random(series * 1000 + chapters)
+    tag_names: List[str] = [f"Tag {i}" for i in range(tags)]
+    # a handful of distinct pages, real libraries do not compress better because of repeated pages anyway
+    page_pool: List[bytes] = [generate_page(rng, page_width, page_height) for _ in range(8)]
+    ff_page: bytes = generate_ff_bz2(rng, page_width, page_height)
+    for i in range(series):
+        directory: str = path.join(root, f"Group {i // 50}", f"Series {i}")
+        os.makedirs(directory)
+        with open(path.join(directory, cbzerv.TAGFILE_NAME), "w") as tagfile:
+            tagfile.write("\n".join(rng.sample(tag_names, min(rng.randint(5, 15), tags))) + "\n")
+        if i % 2 == 0:
+            with open(path.join(directory, "folder.png"), "wb") as file_handle:
+                file_handle.write(page_pool[0])
+        for c in range(1, chapters + 1):
+            with zipfile.ZipFile(path.join(directory, f"Chapter {c}.cbz"), "w") as cbz:
+                for p in range(1, pages + 1):
+                    # stored and deflated members alternate, the last page is farbfeld
+                    if p == pages:
+                        cbz.writestr(f"{p:03}.ff.bz2", ff_page, zipfile.ZIP_STORED)
+                    else:
+                        cbz.writestr(f"{p:03}.png", page_pool[p % len(page_pool)], zipfile.ZIP_STORED if p % 2 else zipfile.ZIP_DEFLATED)
+        if i % 10 == 0:
+            with open(path.join(directory, "Extras.pdf"), "wb") as file_handle:
+                file_handle.write(generate_pdf(f"Series {i}"))
+        if i % 25 == 0:
+            # neither listed nor searchable
+            ignored: str = path.join(directory, "Ignored")
+            os.makedirs(ignored)
+            open(path.join(ignored, ".ignore"), "w").close()
+            with open(path.join(ignored, cbzerv.TAGFILE_NAME), "w") as tagfile:
+                tagfile.write(tag_names[0] + "\n")
+
+def url(*parts: str, **query: str) -> str:
+    result: str = "/" + "/".join(quote(i) for i in parts)
+    return f"{result}?{urlencode(query)}" if query else result
+
+def scenarios(series: int, chapters: int, pages: int, tags: int, seed: int) -> Dict[str, Callable[[], str]]:
+    # scenario -> generator of the next url
+    rng: random.Random = random.Random(seed)
+
+    def series_dir(i: Optional[int] = None) -> Tuple[str, str]:
+        i = rng.randrange(series) if i is None else i
+        return f"Group {i // 50}", f"Series {i}"
+
+    def chapter() -> Tuple[str, str, str]:
+        return (*series_dir(), f"Chapter {rng.randint(1, chapters)}.cbz")
+
+    def search() -> str:
+        return url("query", q=f"Tag {rng.randrange(tags)}|Tag {rng.randrange(tags)}, -Tag {rng.randrange(tags)}")
+
+    return {
+        "index": lambda: url(*series_dir()[:rng.randint(0, 2)]),
+        "query page": lambda: url("query"),
+        "search": search,
+        "cbz page": lambda: url(*chapter()),
+        "cbz image": lambda: url(*chapter(), image=f"{rng.randint(1, pages - 1):03}.png"),
+        "cbz ff.bz2": lambda: url(*chapter(), image=f"{pages:03}.ff.bz2"),
+        "pdf": lambda: url(*series_dir(rng.randrange(0, series, 10)), "Extras.pdf"),
+    }
+
+
+class InProcessHandler(cbzerv.RequestHandler):
+    # handles one request from/ to memory, without a socket
+    def __init__(self, raw_request: bytes) -> None:
+        self.rfile = io.BytesIO(raw_request)
+        self.wfile = io.BytesIO()
+        self.client_address = ("127.0.0.1", 0)
+        self.close_connection = True
+        self.handle_one_request()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+class QuietHandler(cbzerv.RequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+class QuietKeepAliveHandler(cbzerv.KeepAliveRequestHandler):
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+def request_in_process(target: str) -> Tuple[int, int]:
+    response: bytes = InProcessHandler(f"GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()).wfile.getvalue()
+    return int(response[9:12]), len(response)
+
+def request_socket(port: int, keep_alive: bool = False) -> Callable[[str], Tuple[int, int]]:
+    connections: local = local()  # keep_alive: one connection per client-thread
+
+    def request(target: str) -> Tuple[int, int]:
+        connection: Optional[http.client.HTTPConnection] = getattr(connections, "connection", None) if keep_alive else None
+        if connection is None:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            connections.connection = connection
+        try:
+            connection.request("GET", target)
+            response: http.client.HTTPResponse = connection.getresponse()
+            return response.status, len(response.read())
+        finally:
+            if not keep_alive or response.will_close:
+                connection.close()
+                connections.connection = None
+    return request
+
+def run_scenario(request: Callable[[str], Tuple[int, int]], next_url: Callable[[], str], count: int, concurrency: int) -> Dict[str, float]:
+    urls: List[str] = [next_url() for _ in range(count)]
+    for i in urls[:min(count, 5)]:
+        request(i)  # warm up
+    timings: List[float] = []
+    errors: List[int] = [0]
+    transferred: List[int] = [0]
+    lock: Lock = Lock()
+
+    def worker(worker_urls: List[str]) -> None:
+        for target in worker_urls:
+            start: float = perf_counter()
+            status, size = request(target)
+            elapsed: float = perf_counter() - start
+            with lock:
+                timings.append(elapsed)
+                transferred[0] += size
+                if status >= 400:
+                    errors[0] += 1
+
+    start: float = perf_counter()
+    workers: List[Thread] = [Thread(target=worker, args=(urls[i::concurrency],)) for i in range(concurrency)]
+    for i in workers:
+        i.start()
+    for i in workers:
+        i.join()
+    wall_time: float = perf_counter() - start
+    timings.sort()
+    return {
+        "p50": percentile(timings, 0.50) * 1000,
+        "p90": percentile(timings, 0.90) * 1000,
+        "p99": percentile(timings, 0.99) * 1000,
+        "max": timings[-1] * 1000,
+        "req/s": len(timings) / wall_time,
+        "MiB/s": transferred[0] / wall_time / 1024 / 1024,
+        "errors": errors[0],
+    }
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on linux
+
+def print_results(mode: str, results: Dict[str, Dict[str, float]]) -> None:
+    print(f"{mode}:")
+    print(f"  {'scenario':<12} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>9} {'MiB/s':>8} {'errors':>6}")
+    for name, r in results.items():
+        print(f"  {name:<12} {r['p50']:8.2f} {r['p90']:8.2f} {r['p99']:8.2f} {r['max']:8.2f} {r['req/s']:9.1f} {r['MiB/s']:8.2f} {r['errors']:6.0f}")
+    print(f"  peak RSS: {peak_rss_mib():.1f} MiB")
+
+def main(
+    library: Optional[str],
+    series: int,
+    chapters: int,
+    pages: int,
+    tags: int,
+    page_width: int,
+    page_height: int,
+    requests: int,
+    concurrency: int,
+    threads: int,
+    processes: int,
+    modes: List[str],
+    only: List[str],
+) -> None:
+    temporary: bool = library is None
+    root: str = path.abspath(library or tempfile.mkdtemp(prefix="cbzerv-benchmark-"))
+    if temporary or not path.exists(root):
+        start: float = perf_counter()
+        generate_library(root, series, chapters, pages, tags, page_width, page_height)
+        print(f"generated {series} series x {chapters} chapters x {pages} pages in {perf_counter() - start:.1f}s ({root})")
+    os.chdir(root)
+    if processes > 0:
+        cbzerv.cpu_pool = ProcessPoolExecutor(max_workers=processes)
+        cbzerv.cpu_pool.submit(abs, 0).result()
+    server: Optional[cbzerv.PooledHTTPServer] = None
+    async_server: Optional[cbzerv.AsyncHTTPServer] = None
+    try:
+        start = perf_counter()
+        cbzerv.get_tag_index()
+        print(f"tag index built in {(perf_counter() - start) * 1000:.1f}ms")
+        selected: Dict[str, Callable[[], str]] = {
+            name: next_url for name, next_url in scenarios(series, chapters, pages, tags, seed=series).items()
+            if not only or name in only
+        }
+        if "in-process" in modes:
+            print_results("in-process", {
+                name: run_scenario(request_in_process, next_url, requests, 1)
+                for name, next_url in selected.items()
+            })
+        if "socket" in modes:
+            server = cbzerv.PooledHTTPServer(("127.0.0.1", 0), QuietHandler, threads)
+            Thread(target=server.serve_forever, daemon=True).start()
+            print_results(f"socket ({concurrency} clients, {threads} threads)", {
+                name: run_scenario(request_socket(server.server_address[1]), next_url, requests, concurrency)
+                for name, next_url in selected.items()
+            })
+        if "asyncio" in modes:
+            async_server = cbzerv.AsyncHTTPServer(("127.0.0.1", 0), threads, QuietKeepAliveHandler)
+            Thread(target=async_server.serve_forever, daemon=True).start()
+            print_results(f"asyncio keep-alive ({concurrency} clients, {threads} threads)", {
+                name: run_scenario(request_socket(async_server.server_address[1], keep_alive=True), next_url, requests, concurrency)
+                for name, next_url in selected.items()
+            })
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if async_server is not None:
+            async_server.shutdown()
+            async_server.server_close()
+        if cbzerv.cpu_pool is not None:
+            cbzerv.cpu_pool.shutdown(wait=False, cancel_futures=True)
+        if temporary:
+            os.chdir(path.dirname(root))
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="benchmark.py",
+        description="Benchmark cbzerv on a synthetic library",
+    )
+    parser.add_argument("--library", help="generate the library here (kept) or reuse it if it exists (default: temporary)")
+    parser.add_argument("--series", type=int, default=100)
+    parser.add_argument("--chapters", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--page-width", type=int, default=400)
+    parser.add_argument("--page-height", type=int, default=600)
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="clients for the socket benchmark")
+    parser.add_argument("--threads", type=int, default=8, help="server threads for the socket benchmark")
+    parser.add_argument("--processes", type=int, default=0, help="cpu-bound work in processes (like PROCESSES)")
+    parser.add_argument("--mode", action="append", choices=["in-process", "socket", "asyncio"], help="default: all")
+    parser.add_argument("--only", action="append", default=[], help="run only this scenario (can be repeated)")
+    args = parser.parse_args()
+    main(
+        args.library, args.series, args.chapters, args.pages, args.tags, args.page_width, args.page_height,
+        args.requests, args.concurrency, args.threads, args.processes, args.mode or ["in-process", "socket", "asyncio"], args.only,
+    )
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# Losslessly shrink cbz files: png image-data gets re-deflated, images optionally converted to .ff.bz2 (whichever is smaller)
+# members are streamed from the source cbz through a process-pool into a new archive, which replaces the source once complete
+# usage: python3 tools/cbz_optimizer.py --use-ff --state optimizer_state.json ./library
+
+import bz2
+import json
+import os
+import stat
+import struct
+import sys
+import tempfile
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor
+from os import path
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+import cbzerv  # noqa: E402
+
+PNG_SIGNATURE: bytes = b"\x89PNG\r\n\x1a\n"
+# webp and gif support animations, ff does not; svg would be lossy
+FF_SOURCE_EXTENSIONS: List[str] = ["jpeg", "jpg", "png"]
+# members only get deflated if that saves at least 10% (images usually do not compress any further -> stored)
+MIN_DEFLATE_RATIO: float = 0.9
+
+OptimizedMember = Tuple[str, bytes, int]  # name, data, compress_type
+
+
+def recompress_png(data: bytes) -> bytes:
+    # same chunks and pixels (even the same filters), just the image-data deflated as good as zlib can
+    if data[:8] != PNG_SIGNATURE:
+        return data
+    chunks: List[Tuple[bytes, Optional[bytes]]] = []
+    image_data: List[bytes] = []
+    pos: int = 8
+    while pos + 12 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        if chunk_type == b"IDAT":
+            if not image_data:
+                chunks.append((chunk_type, None))  # placeholder for the merged IDAT
+            image_data.append(data[pos + 8:pos + 8 + length])
+        else:
+            chunks.append((chunk_type, data[pos + 8:pos + 8 + length]))
+        pos += 12 + length
+    if not image_data or chunks[-1][0] != b"IEND":
+        return data  # truncated/ broken -> do not touch it
+    raw: bytes = zlib.decompress(b"".join(image_data))
+    candidates: List[bytes] = []
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        candidates.append(compressor.compress(raw) + compressor.flush())
+    deflated: bytes = min(candidates, key=len)
+    result: bytes = PNG_SIGNATURE + b"".join(
+        cbzerv._png_chunk(chunk_type, deflated if body is None else body) for chunk_type, body in chunks
+    )
+    return result if len(result) < len(data) else data
+
+def to_ff_bz2(data: bytes) -> Optional[bytes]:
+    # None: not convertible without losing something (16bit, animated, ..) or Pillow is missing
+    if not cbzerv.PIL_AVAILABLE:
+        return None
+    import io
+    from PIL import Image  # type: ignore
+    if data[:8] == PNG_SIGNATURE and len(data) > 24 and data[24] == 16:
+        return None  # Pillow reduces 16bit rgb(a) to 8bit
+    with Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False) or image.mode in ("I", "I;16", "F", "CMYK"):
+            return None
+        width, height = image.size
+        rgba: bytes = image.convert("RGBA").tobytes()
+    # 8bit -> 16bit by repeating each byte (v * 257), cbzerv reads back the high byte
+    pixels: bytearray = bytearray(len(rgba) * 2)
+    pixels[0::2] = rgba
+    pixels[1::2] = rgba
+    return bz2.compress(b"farbfeld" + struct.pack(">II", width, height) + bytes(pixels), 9)
+
+def optimize_member(name: str, data: bytes, use_ff: bool) -> OptimizedMember:
+    # runs within the process-pool
+    extension: str = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    try:
+        if extension == "png":
+            data = recompress_png(data)
+        if use_ff and extension in FF_SOURCE_EXTENSIONS:
+            ff_bz2: Optional[bytes] = to_ff_bz2(data)
+            if ff_bz2 is not None and len(ff_bz2) < len(data):
+                name, data = name.rsplit(".", 1)[0] + ".ff.bz2", ff_bz2
+    except Exception as e:
+        sys.stderr.write(f"  keeping {name} as it is: {e!r}\n")
+    deflated_size: int = len(zlib.compress(data, 6))
+    return name, data, ZIP_DEFLATED if deflated_size < len(data) * MIN_DEFLATE_RATIO else ZIP_STORED
+
+
+def optimize_cbz(file: str, pool: ProcessPoolExecutor, workers: int, use_ff: bool, dry_run: bool) -> Tuple[int, int]:
+    # -> (size before, size after)
+    old_stat: os.stat_result = os.stat(file)
+    old_size: int = old_stat.st_size
+    with ZipFile(file, "r") as source:
+        infos: List[ZipInfo] = [i for i in source.infolist() if not i.is_dir()]
+        names: set = {i.filename for i in infos}
+        # pages in reading order first (like cbzerv sorts them), everything else after
+        infos.sort(key=lambda i: (not cbzerv.is_image_member(i.filename), cbzerv._sort_human_key(i.filename)))
+        fd, temp_file = tempfile.mkstemp(dir=path.dirname(file), prefix=".", suffix=".cbz.tmp")
+        try:
+            with open(fd, "wb") as output, ZipFile(output, "w") as target:
+                # bounded amount of members in flight -> bounded memory, no matter how big the cbz is
+                in_flight: Deque[Tuple[ZipInfo, Future]] = deque()
+                written: set = set()
+
+                def write_next() -> None:
+                    info, future = in_flight.popleft()
+                    name, data, compress_type = future.result()
+                    if name != info.filename and (name in names or name in written):
+                        # would collide (01.png and 01.jpg both become 01.ff.bz2)
+                        name, data, compress_type = info.filename, source.read(info), ZIP_STORED
+                    written.add(name)
+                    zinfo: ZipInfo = ZipInfo(name, date_time=info.date_time)
+                    zinfo.external_attr = info.external_attr
+                    zinfo.compress_type = compress_type
+                    target.writestr(zinfo, data, compresslevel=9 if compress_type == ZIP_DEFLATED else None)
+
+                for info in infos:
+                    in_flight.append((info, pool.submit(optimize_member, info.filename, source.read(info), use_ff)))
+                    if len(in_flight) >= workers * 2:
+                        write_next()
+                while in_flight:
+                    write_next()
+            new_size: int = path.getsize(temp_file)
+            with ZipFile(temp_file, "r") as check:
+                broken: Optional[str] = check.testzip()
+                written_names: List[str] = check.namelist()
+            if broken is not None:
+                raise RuntimeError(f"{broken} is broken within the optimized version")
+            if len(written_names) != len(infos) or len(set(written_names)) != len(written_names):
+                raise RuntimeError("members got lost or duplicated within the optimized version")
+            if dry_run or new_size >= old_size:
+                os.unlink(temp_file)
+                return old_size, min(new_size, old_size)
+            os.chmod(temp_file, stat.S_IMODE(old_stat.st_mode))  # mkstemp creates it as 0600
+            os.replace(temp_file, file)  # atomic: cbzerv (or a crash) never sees a half-written cbz
+            return old_size, new_size
+        except BaseException:
+            try:
+                os.unlink(temp_file)
+            except FileNotFoundError:
+                pass
+            raise
+
+
+def find_cbz_files(paths: List[str]) -> Iterator[str]:
+    for i in paths:
+        if path.isdir(i):
+            for directory, dirs, files in os.walk(i):
+                dirs.sort(key=cbzerv._sort_human_key)
+                yield from (path.join(directory, f) for f in sorted(files, key=cbzerv._sort_human_key) if f.lower().endswith(".cbz"))
+        else:
+            yield i
+
+
+def load_state(state_file: Optional[str]) -> Dict[str, dict]:
+    if state_file is None or not path.exists(state_file):
+        return {"done": {}, "saved": 0}
+    with open(state_file, "r") as fp:
+        return json.load(fp)
+
+def save_state(state_file: Optional[str], state: Dict[str, dict]) -> None:
+    if state_file is None:
+        return
+    with open(state_file + ".tmp", "w") as fp:
+        json.dump(state, fp)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def main(paths: List[str], workers: int, use_ff: bool, state_file: Optional[str], dry_run: bool) -> None:
+    if use_ff and not cbzerv.PIL_AVAILABLE:
+        sys.exit("--use-ff requires Pillow (https://python-pillow.org)")
+    # finished files are remembered (path -> size and mtime afterwards), so an interrupted run can be resumed
+    state: Dict[str, dict] = load_state(state_file)
+    total_before: int = 0
+    total_after: int = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for file in find_cbz_files(paths):
+            key: str = path.abspath(file)
+            file_stat: os.stat_result = os.stat(file)
+            if state["done"].get(key) == [file_stat.st_size, file_stat.st_mtime_ns]:
+                continue
+            try:
+                before, after = optimize_cbz(file, pool, workers, use_ff, dry_run)
+            except Exception as e:
+                print(f"{file}: failed ({e!r})")
+                continue
+            total_before += before
+            total_after += after
+            print(f"{file}: {before} -> {after} bytes ({(before - after) / max(before, 1):.1%} saved)")
+            if not dry_run:
+                file_stat = os.stat(file)
+                state["done"][key] = [file_stat.st_size, file_stat.st_mtime_ns]
+                state["saved"] += before - after
+                save_state(state_file, state)
+    print(f"total: {total_before} -> {total_after} bytes, saved {total_before - total_after} bytes ({(total_before - total_after) / max(total_before, 1):.1%})")
+    if state_file is not None and not dry_run:
+        print(f"saved across all runs with this state-file: {state['saved']} bytes")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="cbz_optimizer.py",
+        description="Losslessly reduce the size of cbz files",
+    )
+    parser.add_argument("paths", nargs="+", help="cbz files and/ or directories (searched recursively)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="size of the process-pool (default: amount of cpus)")
+    parser.add_argument("--use-ff", action="store_true", help="convert images to .ff.bz2 if that is smaller (requires Pillow)")
+    parser.add_argument("--state", help="remember finished files in this file to resume (or repeat) a batch-run later")
+    parser.add_argument("--dry-run", action="store_true", help="only report how much would be saved")
+    args = parser.parse_args()
+    main(args.paths, max(args.workers, 1), args.use_ff, args.state, args.dry_run)